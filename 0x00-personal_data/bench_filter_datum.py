@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the filter_datum engines against the former per field
+re.sub loop
+
+Usage: ./bench_filter_datum.py [--lines N] [--policies 5,50,200,1000]
+                               [--budget SECONDS]
+
+Each policy redacts PII_FIELDS plus synthetic fields up to the given
+count, over log lines shaped like the ones main() emits. A run stops
+after N lines or after the time budget, whichever comes first. Results
+are printed as JSON, in lines per second.
+"""
+import argparse
+import json
+import random
+import re
+import time
+from functools import partial
+from typing import Callable, List
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, filter_datum
+
+REDACTION = RedactingFormatter.REDACTION
+SEPARATOR = RedactingFormatter.SEPARATOR
+
+
+def per_field_filter_datum(fields: List[str], redaction: str,
+                           message: str, separator: str) -> str:
+    """The filter_datum implementation before the single pass engine"""
+    for f in fields:
+        message = re.sub(f'{f}=.*?{separator}',
+                         f'{f}={redaction}{separator}', message)
+    return message
+
+
+def make_policy(size: int) -> List[str]:
+    """Returns PII_FIELDS padded with synthetic fields to size fields"""
+    fields = list(PII_FIELDS)
+    fields += ["pii_field_{}".format(i) for i in range(size - len(fields))]
+    return fields[:size]
+
+
+def make_lines(count: int) -> List[str]:
+    """Returns count distinct rows in the format logged by main()"""
+    rng = random.Random(0)
+    lines = []
+    for i in range(count):
+        lines.append(
+            "name=user{0}; email=user{0}@example.com; phone=555-{1:04d}; "
+            "ssn={2:09d}; password=hash{0}; ip=10.0.{3}.{4}; "
+            "last_login=2019-11-14 06:16:24; user_agent=Mozilla/5.0;".format(
+                i, rng.randrange(10000), rng.randrange(10 ** 9),
+                rng.randrange(256), rng.randrange(256)))
+    return lines
+
+
+def run(func: Callable, fields: List[str], lines: List[str],
+        total: int, budget: float) -> float:
+    """Redacts total lines, cycling over lines, for at most budget
+    seconds
+
+    Returns:
+        float: the throughput in lines per second
+    """
+    n_lines = len(lines)
+    start = time.perf_counter()
+    deadline = start + budget
+    done = 0
+    while done < total and time.perf_counter() < deadline:
+        for i in range(done, min(done + 1000, total)):
+            func(fields, REDACTION, lines[i % n_lines], SEPARATOR)
+        done = min(done + 1000, total)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    """Benchmarks each policy and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, default=1000000,
+                        help="lines redacted per run (default: 1000000)")
+    parser.add_argument("--policies", default="5,50,200,1000",
+                        help="comma separated field counts "
+                             "(default: 5,50,200,1000)")
+    parser.add_argument("--budget", type=float, default=10,
+                        help="seconds allowed per run (default: 10)")
+    args = parser.parse_args()
+    automaton = partial(filter_datum, engine="automaton")
+
+    lines = make_lines(min(args.lines, 10000))
+    results = {"lines": args.lines, "policies": {}}
+    for size in (int(p) for p in args.policies.split(",")):
+        fields = make_policy(size)
+        for line in lines[:100]:
+            expected = per_field_filter_datum(fields, REDACTION, line,
+                                              SEPARATOR)
+            assert filter_datum(fields, REDACTION, line,
+                                SEPARATOR) == expected
+            assert automaton(fields, REDACTION, line, SEPARATOR) == expected
+        single = run(filter_datum, fields, lines, args.lines, args.budget)
+        fast = run(automaton, fields, lines, args.lines, args.budget)
+        per_field = run(per_field_filter_datum, fields, lines, args.lines,
+                        args.budget)
+        results["policies"][size] = {
+            "single_pass_lines_per_s": round(single),
+            "automaton_lines_per_s": round(fast),
+            "per_field_lines_per_s": round(per_field),
+            "speedup": round(single / per_field, 2),
+            "automaton_speedup": round(fast / per_field, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
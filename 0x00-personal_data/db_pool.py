@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Connection providers for the Personal Data database
+
+A provider hands out DB-API connections: calling close() on one gives
+it back to the provider. get_provider builds the provider described by
+the PERSONAL_DATA_DB_* environment variables:
+
+    PERSONAL_DATA_DB_ENGINE           mysql (default) or sqlite
+    PERSONAL_DATA_DB_USERNAME         default: root
+    PERSONAL_DATA_DB_PASSWORD         default: empty
+    PERSONAL_DATA_DB_HOST             default: localhost
+    PERSONAL_DATA_DB_NAME             database name, or sqlite file path
+    PERSONAL_DATA_DB_POOL_SIZE        default: 5
+    PERSONAL_DATA_DB_CONNECT_TIMEOUT  seconds, default: 10
+    PERSONAL_DATA_DB_READ_TIMEOUT     seconds, default: no timeout
+    PERSONAL_DATA_DB_RETRIES          default: 3
+"""
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from os import environ
+from typing import Any, Optional
+
+import mysql.connector
+from mysql.connector import pooling
+
+
+class ConnectionProvider(ABC):
+    """
+    Hands out DB-API connections
+    """
+
+    @abstractmethod
+    def connect(self) -> Any:
+        """
+        Returns a DB-API connection, to be closed after use
+        """
+
+    def close(self) -> None:
+        """
+        Releases the resources held by the provider
+        """
+
+
+class MySQLPoolProvider(ConnectionProvider):
+    """
+    Provider reusing the connections of a mysql.connector pool
+    """
+
+    def __init__(self, user: str, password: str, host: str,
+                 database: Optional[str], pool_size: int = 5,
+                 connect_timeout: float = 10,
+                 read_timeout: Optional[float] = None,
+                 retries: int = 3, retry_delay: float = 0.5):
+        """
+        Constructor method for MySQLPoolProvider class
+
+        The pool is created on the first connect, so a provider can be
+        built before the server is reachable.
+
+        Args:
+            user, password, host, database: connection settings
+            pool_size: number of connections kept open
+            connect_timeout: seconds allowed to open a connection
+            read_timeout: seconds allowed to wait for a result,
+                None to wait forever
+            retries: attempts made after a failed connect
+            retry_delay: seconds before the first retry, doubled
+                after each attempt
+        """
+        self._config = {
+            "user": user,
+            "password": password,
+            "host": host,
+            "database": database,
+            "connection_timeout": connect_timeout,
+        }
+        if read_timeout is not None:
+            self._config["read_timeout"] = read_timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> pooling.PooledMySQLConnection:
+        """
+        Checks a healthy connection out of the pool
+
+        A connection the server dropped is reconnected before it is
+        returned. Failures are retried with an exponential backoff.
+
+        Returns:
+            A pooled connection, given back to the pool by close()
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                cnx = self._get_pool().get_connection()
+                cnx.ping(reconnect=True, attempts=1, delay=0)
+                return cnx
+            except mysql.connector.Error:
+                if attempt == self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def _get_pool(self) -> pooling.MySQLConnectionPool:
+        """
+        Returns the pool, creating it on the first call
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = pooling.MySQLConnectionPool(
+                    pool_name="personal_data_{}".format(id(self)),
+                    pool_size=self.pool_size,
+                    pool_reset_session=True,
+                    **self._config)
+            return self._pool
+
+    def close(self) -> None:
+        """
+        Closes the idle connections of the pool
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool._remove_connections()
+                self._pool = None
+
+
+class SQLiteProvider(ConnectionProvider):
+    """
+    Provider opening a local SQLite file, for local runs and tests
+    """
+
+    def __init__(self, path: str, connect_timeout: float = 10):
+        """
+        Constructor method for SQLiteProvider class
+
+        Args:
+            path: the database file
+            connect_timeout: seconds to wait for a lock on the file
+        """
+        self.path = path
+        self.connect_timeout = connect_timeout
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens a connection to the database file
+        """
+        return sqlite3.connect(self.path, timeout=self.connect_timeout)
+
+
+def provider_from_env() -> ConnectionProvider:
+    """
+    Builds the provider described by the environment variables
+
+    Returns:
+        A SQLiteProvider if PERSONAL_DATA_DB_ENGINE is sqlite,
+        a MySQLPoolProvider otherwise
+    """
+    connect_timeout = float(
+        environ.get("PERSONAL_DATA_DB_CONNECT_TIMEOUT", "10"))
+    db_name = environ.get("PERSONAL_DATA_DB_NAME")
+
+    if environ.get("PERSONAL_DATA_DB_ENGINE", "mysql").lower() == "sqlite":
+        return SQLiteProvider(db_name, connect_timeout)
+
+    read_timeout = environ.get("PERSONAL_DATA_DB_READ_TIMEOUT")
+    return MySQLPoolProvider(
+        user=environ.get("PERSONAL_DATA_DB_USERNAME", "root"),
+        password=environ.get("PERSONAL_DATA_DB_PASSWORD", ""),
+        host=environ.get("PERSONAL_DATA_DB_HOST", "localhost"),
+        database=db_name,
+        pool_size=int(environ.get("PERSONAL_DATA_DB_POOL_SIZE", "5")),
+        connect_timeout=connect_timeout,
+        read_timeout=float(read_timeout) if read_timeout else None,
+        retries=int(environ.get("PERSONAL_DATA_DB_RETRIES", "3")))
+
+
+def get_provider() -> ConnectionProvider:
+    """
+    Returns the provider of the process, built from the environment
+    on the first call
+    """
+    global _provider
+
+    with _provider_lock:
+        if _provider is None:
+            _provider = provider_from_env()
+        return _provider
+
+
+_provider = None
+_provider_lock = threading.Lock()
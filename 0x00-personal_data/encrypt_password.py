@@ -1,23 +1,137 @@
 #!/usr/bin/env python3
 """
 Password Encryption and Validation Module
+
+The bcrypt cost factor is calibrated on the host, see calibrate_rounds:
+
+    BCRYPT_TARGET_MS   target duration of one hash, default: 250
+    BCRYPT_MIN_ROUNDS  lowest cost factor ever used, default: 10
+    BCRYPT_MAX_ROUNDS  highest cost factor ever used, default: 16
 """
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
 import bcrypt
 
+# Passwords sent to a worker process at a time by the batch functions
+CHUNK_SIZE = 64
+# Cost factor timed by calibrate_rounds, cheap enough to time quickly
+_PROBE_ROUNDS = 8
+# Cost factor of a bcrypt hash such as $2b$12$...
+_COST = re.compile(rb'^\$2[abxy]?\$(\d\d)\$')
+
+
+def calibrate_rounds(target_ms: Optional[float] = None,
+                     min_rounds: Optional[int] = None,
+                     max_rounds: Optional[int] = None,
+                     refresh: bool = False) -> int:
+    """
+        Picks the highest bcrypt cost factor whose hash takes at most
+        the target duration on this host.
+
+        Each round doubles the cost of a hash, so one cheap hash is
+        timed and the duration of the others is extrapolated from it,
+        then the chosen factor is timed once to confirm it. The result
+        is cached for the process.
+
+        Args:
+                target_ms (float, optional): The target duration of one
+                hash, in milliseconds. Defaults to $BCRYPT_TARGET_MS.
+                min_rounds (int, optional): The lowest factor returned,
+                even on a slow host. Defaults to $BCRYPT_MIN_ROUNDS.
+                max_rounds (int, optional): The highest factor returned.
+                Defaults to $BCRYPT_MAX_ROUNDS.
+                refresh (bool): Whether to time the host again instead
+                of returning the cached factor.
+
+        Returns:
+                int: The cost factor to hash passwords with.
+        """
+    if target_ms is None:
+        target_ms = float(os.getenv('BCRYPT_TARGET_MS', '250'))
+    if min_rounds is None:
+        min_rounds = int(os.getenv('BCRYPT_MIN_ROUNDS', '10'))
+    if max_rounds is None:
+        max_rounds = int(os.getenv('BCRYPT_MAX_ROUNDS', '16'))
+    if refresh:
+        _calibrate.cache_clear()
+    return _calibrate(target_ms, min_rounds, max_rounds)
+
+
+@lru_cache(maxsize=16)
+def _calibrate(target_ms: float, min_rounds: int, max_rounds: int) -> int:
+    """Times the host for calibrate_rounds"""
+    probe_ms = min(_time_hash(_PROBE_ROUNDS) for _ in range(3))
+    rounds = _PROBE_ROUNDS
+    while rounds < max_rounds and probe_ms * 2 <= target_ms:
+        probe_ms *= 2
+        rounds += 1
+    # 4 is the lowest cost factor bcrypt accepts
+    while rounds > 4 and probe_ms > target_ms:
+        probe_ms /= 2
+        rounds -= 1
+    rounds = max(min_rounds, min(rounds, max_rounds))
+    if rounds > min_rounds and _time_hash(rounds) > target_ms * 1.5:
+        # The extrapolation was too optimistic
+        rounds -= 1
+    return rounds
 
-def hash_password(password: str) -> bytes:
+
+def _time_hash(rounds: int) -> float:
+    """Returns the duration of one hash with the given cost, in ms"""
+    salt = bcrypt.gensalt(rounds)
+    start = time.perf_counter()
+    bcrypt.hashpw(b'calibration', salt)
+    return (time.perf_counter() - start) * 1000
+
+
+def needs_rehash(hashed_password: bytes,
+                 rounds: Optional[int] = None) -> bool:
+    """
+        Tells whether a hash was made with another cost factor than the
+        current one, in which case the password should be hashed again
+        the next time it is known, e.g. at login.
+
+        Args:
+                hashed_password (bytes): A byte string representing
+                the salted, hashed password.
+                rounds (int, optional): The cost factor expected.
+                Defaults to calibrate_rounds().
+
+        Returns:
+                bool: True if the cost differs or cannot be read.
+        """
+    match = _COST.match(hashed_password)
+    if match is None:
+        return True
+    if rounds is None:
+        rounds = calibrate_rounds()
+    return int(match.group(1)) != rounds
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> bytes:
     """
         Generates a salted and hashed password.
 
         Args:
                 password (str): A string containing the plain text
                 password to be hashed.
+                rounds (int, optional): The bcrypt cost factor.
+                Defaults to calibrate_rounds().
 
         Returns:
                 bytes: A byte string representing the salted, hashed password.
         """
+    if rounds is None:
+        rounds = calibrate_rounds()
     encoded = password.encode()
-    hashed = bcrypt.hashpw(encoded, bcrypt.gensalt())
+    hashed = bcrypt.hashpw(encoded, bcrypt.gensalt(rounds))
 
     return hashed
 
@@ -26,6 +140,9 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     """
         Validates whether the provided password matches the hashed password.
 
+        Once a password is valid, needs_rehash(hashed_password) tells
+        whether it should be hashed again with the current cost factor.
+
         Args:
                 hashed_password (bytes): A byte string representing
                 the salted, hashed password.
@@ -41,3 +158,95 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     if bcrypt.checkpw(encoded, hashed_password):
         valid = True
     return valid
+
+
+def hash_passwords(passwords: Iterable[str], rounds: Optional[int] = None,
+                   workers: Optional[int] = None,
+                   chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+        Hashes many passwords across a pool of processes.
+
+        The passwords are read lazily and sent to the workers in chunks,
+        with at most two chunks per worker in flight, so any number of
+        passwords can be hashed in a fixed amount of memory.
+
+        Args:
+                passwords (Iterable[str]): The plain text passwords.
+                rounds (int, optional): The bcrypt cost factor.
+                Defaults to calibrate_rounds().
+                workers (int, optional): The number of processes.
+                Defaults to the CPU count; 1 hashes on the calling thread.
+                chunk_size (int): The passwords sent to a process at once.
+
+        Returns:
+                Iterator[bytes]: The hashed passwords, in input order.
+        """
+    if rounds is None:
+        # Calibrated once here rather than in every worker
+        rounds = calibrate_rounds()
+    return _map_chunks(_hash_chunk, passwords, workers, chunk_size, rounds)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]],
+                workers: Optional[int] = None,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[bool]:
+    """
+        Validates many passwords across a pool of processes.
+
+        Each pair is checked as is_valid would check it, except that a
+        malformed hash counts as invalid instead of raising, so that one
+        bad row does not stop an audit.
+
+        Args:
+                pairs (Iterable[Tuple[bytes, str]]): The
+                (hashed_password, password) pairs to validate.
+                workers (int, optional): The number of processes.
+                Defaults to the CPU count; 1 checks on the calling thread.
+                chunk_size (int): The pairs sent to a process at once.
+
+        Returns:
+                Iterator[bool]: Whether each password matches its hash,
+                in input order.
+        """
+    return _map_chunks(_verify_chunk, pairs, workers, chunk_size)
+
+
+def _hash_chunk(passwords: List[str], rounds: int) -> List[bytes]:
+    """Hashes a chunk of passwords in a worker process"""
+    return [hash_password(password, rounds) for password in passwords]
+
+
+def _verify_chunk(pairs: List[Tuple[bytes, str]]) -> List[bool]:
+    """Validates a chunk of passwords in a worker process"""
+    results = []
+    for hashed_password, password in pairs:
+        try:
+            results.append(is_valid(hashed_password, password))
+        except ValueError:
+            results.append(False)
+    return results
+
+
+def _map_chunks(func: Callable, items: Iterable, workers: Optional[int],
+                chunk_size: int, *args) -> Iterator:
+    """
+        Applies func(chunk, *args) to the items, chunk_size at a time,
+        and yields the results of every chunk in input order.
+        """
+    workers = workers or os.cpu_count() or 1
+    items = iter(items)
+    chunks = iter(lambda: list(islice(items, chunk_size)), [])
+
+    if workers == 1:
+        for chunk in chunks:
+            yield from func(chunk, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(func, chunk, *args))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
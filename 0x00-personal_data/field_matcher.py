@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Multi-pattern matcher redacting `field=value;` pairs in one pass,
+whatever the number of fields
+
+Every key ends with '=', so the automaton only has to be run where the
+message holds a '=': the keys ending there are found by walking a trie
+of the reversed field names back from it. A field holds no '=', so the
+walks never overlap and a message is read at most twice, which keeps
+the cost linear in its length and independent of the field count.
+"""
+from typing import Dict, List, Optional
+
+# Key of the trie nodes ending a field name
+_END = ''
+
+
+class FieldMatcher:
+    """
+    Redacts the values of a set of fields, with the same result as
+    the pattern `(field1|field2|...)=.*?separator` of filter_datum
+
+    Fields must be non empty and hold no '=', separator or newline.
+    """
+
+    def __init__(self, fields: List[str], redaction: str, separator: str):
+        """
+        Constructor method for FieldMatcher class
+
+        Args:
+            fields: list of fields to redact
+            redaction: the value to use for redaction
+            separator: the separator to use between fields
+        """
+        self.redaction = redaction
+        self.separator = separator
+        self._trie: Dict[str, dict] = {}
+        for field in fields:
+            node = self._trie
+            for char in reversed(field):
+                node = node.setdefault(char, {})
+            node[_END] = True
+
+    def _key_start(self, message: str, lower: int, eq: int) -> Optional[int]:
+        """
+        Finds the longest field name ending right before a '='
+
+        Args:
+            message: the message being redacted
+            lower: index before which no key can start
+            eq: index of the '='
+
+        Returns:
+            The index where the key starts, or None if no field ends
+            at eq
+        """
+        node = self._trie
+        start = None
+        i = eq - 1
+        while i >= lower:
+            node = node.get(message[i])
+            if node is None:
+                break
+            if _END in node:
+                start = i
+            i -= 1
+        return start
+
+    def redact(self, message: str) -> str:
+        """
+        Replaces the value of every field with the redaction
+
+        Like the pattern it stands for, a key is only redacted if the
+        separator follows it on the same line, and the search resumes
+        after that separator.
+
+        Args:
+            message: the string message to filter
+
+        Returns:
+            The filtered string message with redacted values
+        """
+        separator = self.separator
+        parts = []
+        done = 0
+        eq = message.find('=')
+        while eq != -1:
+            if self._key_start(message, done, eq) is None:
+                eq = message.find('=', eq + 1)
+                continue
+            end = message.find(separator, eq + 1)
+            if end == -1:
+                # No separator left for this key or any later one
+                break
+            newline = message.find('\n', eq + 1, end)
+            if newline != -1:
+                # No key can be redacted on the rest of this line
+                eq = message.find('=', newline + 1)
+                continue
+            parts.append(message[done:eq + 1])
+            parts.append(self.redaction)
+            parts.append(separator)
+            done = end + len(separator)
+            eq = message.find('=', done)
+        if not parts:
+            return message
+        parts.append(message[done:])
+        return ''.join(parts)
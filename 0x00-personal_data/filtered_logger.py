@@ -3,125 +3,675 @@
 Script for handling Personal Data
 """
 
-from typing import List
+import atexit
+import copy
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 import re
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from os import environ
-import mysql.connector
+import queue
+import threading
+
+from db_pool import get_provider
+from field_matcher import FieldMatcher
 
 
 # # PII fields to be redacted
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
 
+# Rows fetched per round trip by main
+BATCH_SIZE = 1000
+# Maximum number of records waiting for the log writer thread
+LOG_QUEUE_SIZE = 10000
+# What logging a record does when the queue is full
+OVERFLOW_POLICIES = ("block", "drop-oldest", "sample")
+# How filter_datum finds the fields: one regex alternation, or the
+# FieldMatcher automaton whose cost does not grow with the field count
+ENGINES = ("regex", "automaton")
+# What RedactingFormatter emits: the HOLBERTON text line, or JSON lines
+OUTPUTS = ("text", "json")
+
 
 def filter_datum(fields: List[str], redaction: str,
-                 message: str, separator: str) -> str:
+                 message: str, separator: str,
+                 engine: str = "regex") -> str:
     """
     Replaces sensitive information in a message with a redacted value
     based on the list of fields to redact
 
+    The message is rewritten in a single pass, by one precompiled
+    pattern matching all the fields (see _redactor) or by a FieldMatcher
+    (see _automaton). Both give the same result.
+
     Args:
         fields: list of fields to redact
         redaction: the value to use for redaction
         message: the string message to filter
         separator: the separator to use between fields
+        engine: one of ENGINES. "automaton" is faster for large lists
+            of fields
 
     Returns:
         The filtered string message with redacted values
     """
-    for f in fields:
-        message = re.sub(f'{f}=.*?{separator}',
-                         f'{f}={redaction}{separator}', message)
-    return message
+    redact = _engine_redactor(tuple(fields), separator, redaction, engine)
+    if redact is None:
+        for f in fields:
+            message = re.sub(f'{f}=.*?{separator}',
+                             f'{f}={redaction}{separator}', message)
+        return message
+    return redact(message)
+
+
+# Characters that give a field or separator a regex meaning
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()=')
+
+
+def _single_pass_safe(fields: Tuple[str, ...], separator: str,
+                      redaction: str) -> bool:
+    """
+    Tells whether a single pass gives the result of the per field
+    substitution
+
+    It does not when there is no field, a field or the separator is
+    not a plain string, a field holds the separator, or the redaction
+    holds the separator or a '='. Those cases keep the per field
+    substitution.
+    """
+    if not fields or not all(fields) or \
+            (redaction + separator).find(separator) < len(redaction):
+        return False
+    if '=' in redaction or '\\' in redaction:
+        return False
+    if not _REGEX_SPECIAL.isdisjoint(separator):
+        return False
+    for field in fields:
+        if not _REGEX_SPECIAL.isdisjoint(field) or separator in field:
+            return False
+    return True
+
+
+@lru_cache(maxsize=256)
+def _redactor(fields: Tuple[str, ...], separator: str,
+              redaction: str) -> Optional[Callable[[str], str]]:
+    """
+    Compiles the fields into a single alternation pattern
+
+    Args:
+        fields: tuple of fields to redact
+        separator: the separator to use between fields
+        redaction: the value to use for redaction
+
+    Returns:
+        A function redacting a message in one pass, or None when
+        _single_pass_safe does not hold
+    """
+    if not _single_pass_safe(fields, separator, redaction):
+        return None
+
+    pattern = re.compile('({})=.*?{}'.format('|'.join(fields), separator))
+    # The redacted text of each field, looked up by the matched name
+    replacements = {f: f'{f}={redaction}{separator}' for f in fields}
+    return partial(pattern.sub, lambda m: replacements[m.group(1)])
+
+
+@lru_cache(maxsize=256)
+def _automaton(fields: Tuple[str, ...], separator: str,
+               redaction: str) -> Optional[Callable[[str], str]]:
+    """
+    Builds the FieldMatcher of the fields
+
+    Args:
+        fields: tuple of fields to redact
+        separator: the separator to use between fields
+        redaction: the value to use for redaction
+
+    Returns:
+        The redact method of the matcher, or None when
+        _single_pass_safe does not hold or a field or the separator
+        holds a newline
+    """
+    if not _single_pass_safe(fields, separator, redaction):
+        return None
+    if any('\n' in text for text in fields + (separator,)):
+        return None
+    return FieldMatcher(list(fields), redaction, separator).redact
 
 
-def get_logger() -> logging.Logger:
+def _engine_redactor(fields: Tuple[str, ...], separator: str,
+                     redaction: str,
+                     engine: str) -> Optional[Callable[[str], str]]:
+    """
+    Returns the single pass function of an engine, or None if the
+    fields need the per field substitution
+    """
+    if engine == "automaton":
+        return _automaton(fields, separator, redaction)
+    return _redactor(fields, separator, redaction)
+
+
+def get_logger(queue_size: int = LOG_QUEUE_SIZE,
+               overflow: str = "block",
+               sample_rate: int = 10) -> logging.Logger:
     """
     Returns a Logger object for handling Personal Data
 
+    Records are put on a bounded queue; a background thread redacts
+    them with RedactingFormatter and writes them to stderr. Calling it
+    again returns the same logger, the arguments of the first call
+    being kept. The queue is flushed at exit, or by shutdown_logger.
+
+    Args:
+        queue_size: maximum number of records waiting to be written
+        overflow: what logging does when the queue is full, one of
+            OVERFLOW_POLICIES: wait for room, drop the oldest waiting
+            record, or keep one overflowing record out of sample_rate
+        sample_rate: sampling rate of the "sample" policy
+
     Returns:
         A Logger object with INFO log level and RedactingFormatter
         formatter for filtering PII fields
     """
+    global _listener
+
     logger = logging.getLogger("user_data")
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
+    with _listener_lock:
+        if _listener is not None:
+            return logger
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
 
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(RedactingFormatter(list(PII_FIELDS)))
-    logger.addHandler(stream_handler)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(RedactingFormatter(
+            list(PII_FIELDS),
+            engine=environ.get("PERSONAL_DATA_REDACTION_ENGINE", "regex"),
+            output=environ.get("PERSONAL_DATA_LOG_FORMAT", "text")))
+
+        records = queue.Queue(maxsize=queue_size)
+        logger.addHandler(OverflowQueueHandler(records, overflow,
+                                               sample_rate))
+        _listener = _FlushingQueueListener(records, stream_handler,
+                                           respect_handler_level=True)
+        _listener.start()
 
     return logger
 
 
-def get_db() -> mysql.connector.connection.MySQLConnection:
+def shutdown_logger() -> None:
     """
-    Returns a MySQLConnection object for accessing Personal Data database
+    Writes the records still queued by the user_data logger,
+    then stops its background thread
 
-    Returns:
-        A MySQLConnection object using connection details from
-        environment variables
+    get_logger can be called again afterwards.
+    """
+    global _listener
+
+    with _listener_lock:
+        if _listener is None:
+            return
+        logger = logging.getLogger("user_data")
+        for handler in list(logger.handlers):
+            if isinstance(handler, OverflowQueueHandler):
+                logger.removeHandler(handler)
+        _listener.stop()
+        _listener = None
+
+
+class OverflowQueueHandler(QueueHandler):
+    """
+    QueueHandler for a bounded queue, applying an overflow policy
+    when the queue is full
+    """
+
+    def __init__(self, records: queue.Queue, overflow: str = "block",
+                 sample_rate: int = 10):
+        """
+        Constructor method for OverflowQueueHandler class
+
+        Args:
+            records: the bounded queue to put records on
+            overflow: one of OVERFLOW_POLICIES
+            sample_rate: with "sample", one overflowing record
+                out of sample_rate is kept
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(
+                ", ".join(OVERFLOW_POLICIES)))
+        super(OverflowQueueHandler, self).__init__(records)
+        self.overflow = overflow
+        self.sample_rate = max(1, sample_rate)
+        self.dropped = 0
+        self._overflowed = 0
+        # Guards dropped and _overflowed, only taken on overflow
+        self._lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """
+        Puts a record on the queue, applying the overflow policy
+        if the queue is full
+
+        Only the "block" policy ever waits for room.
+        """
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow == "block":
+            self.queue.put(record)
+        elif self.overflow == "drop-oldest":
+            self._put_evicting(record)
+        else:
+            with self._lock:
+                self._overflowed += 1
+                keep = self._overflowed % self.sample_rate == 0
+                if not keep:
+                    self.dropped += 1
+            if keep:
+                self._put_evicting(record)
+
+    def _put_evicting(self, record: logging.LogRecord) -> None:
+        """
+        Puts a record on the queue without waiting, dropping the
+        oldest waiting records to make room
+        """
+        while True:
+            try:
+                self.queue.get_nowait()
+                with self._lock:
+                    self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                continue
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Prepares a record for the queue, keeping a dict message as is
+        so that RedactingFormatter can redact it by key
+
+        Other records are flattened to their message as QueueHandler
+        does.
+        """
+        if not isinstance(record.msg, dict):
+            return super(OverflowQueueHandler, self).prepare(record)
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(
+                record.exc_info)
+        record.exc_info = None
+        return record
+
+
+# Formats the tracebacks of the records holding a dict message
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class _FlushingQueueListener(QueueListener):
     """
-    username = environ.get("PERSONAL_DATA_DB_USERNAME", "root")
-    password = environ.get("PERSONAL_DATA_DB_PASSWORD", "")
-    host = environ.get("PERSONAL_DATA_DB_HOST", "localhost")
-    db_name = environ.get("PERSONAL_DATA_DB_NAME")
+    QueueListener whose stop waits for room on a full queue
+    instead of failing, so every queued record is written
+    """
+
+    def enqueue_sentinel(self) -> None:
+        """Puts the end marker after the queued records"""
+        self.queue.put(self._sentinel)
 
-    cnx = mysql.connector.connection.MySQLConnection(user=username,
-                                                     password=password,
-                                                     host=host,
-                                                     database=db_name)
-    return cnx
 
+# Background thread writing the user_data records, see get_logger
+_listener = None
+_listener_lock = threading.Lock()
+atexit.register(shutdown_logger)
 
-def main():
+
+def get_db() -> Any:
+    """
+    Returns a connection to the Personal Data database
+
+    Connections come from the pooled provider configured by the
+    PERSONAL_DATA_DB_* environment variables, see db_pool. Closing
+    one gives it back to the pool.
+
+    Returns:
+        A DB-API connection: a pooled MySQL connection, or a sqlite3
+        one when PERSONAL_DATA_DB_ENGINE is sqlite
+    """
+    return get_provider().connect()
+
+
+def main(db=None, batch_size: int = None, workers: int = None):
     """
     Main function to retrieve user data from database and log to console
+
+    Rows are streamed from an unbuffered cursor with fetchmany, so only
+    a few batches are held in memory whatever the size of the table.
+
+    Args:
+        db: DB-API connection to read the users table from, closed at
+            the end. Defaults to get_db()
+        batch_size: rows fetched per round trip. Defaults to
+            $PERSONAL_DATA_BATCH_SIZE, or BATCH_SIZE
+        workers: threads formatting a batch while the next one is
+            fetched, 0 to format on the calling thread. Defaults to
+            $PERSONAL_DATA_WORKERS, or 0
     """
-    db = get_db()
-    cursor = db.cursor()
+    if db is None:
+        db = get_db()
+    if batch_size is None:
+        batch_size = int(environ.get("PERSONAL_DATA_BATCH_SIZE",
+                                     BATCH_SIZE))
+    if workers is None:
+        workers = int(environ.get("PERSONAL_DATA_WORKERS", 0))
+
+    cursor = _streaming_cursor(db)
     cursor.execute("SELECT * FROM users;")
     field_names = [i[0] for i in cursor.description]
+    # Which columns to mask, decided once for the whole table
+    template = redaction_template(field_names, PII_FIELDS)
 
     logger = get_logger()
+    batches = fetch_batches(cursor, batch_size)
 
-    for row in cursor:
-        str_row = ''.join(f'{f}={str(r)}; ' for r, f in zip(row, field_names))
-        logger.info(str_row.strip())
+    if workers <= 0:
+        for batch in batches:
+            _log_lines(logger, format_rows(batch, field_names, template))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # At most workers batches are formatted ahead of the logger
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(format_rows, batch,
+                                               field_names, template))
+                if len(pending) > workers:
+                    _log_lines(logger, pending.popleft().result())
+            while pending:
+                _log_lines(logger, pending.popleft().result())
 
     cursor.close()
     db.close()
 
 
+def _streaming_cursor(db):
+    """
+    Opens an unbuffered cursor, whose rows stay on the server
+    until they are fetched
+
+    Args:
+        db: DB-API connection
+
+    Returns:
+        The cursor. Connections without a buffered option, such as
+        sqlite3 ones, get their default cursor, which already streams.
+    """
+    try:
+        return db.cursor(buffered=False)
+    except TypeError:
+        return db.cursor()
+
+
+def fetch_batches(cursor, batch_size: int) -> Iterator[List[tuple]]:
+    """
+    Yields the rows of an executed cursor, batch_size at a time
+
+    Args:
+        cursor: DB-API cursor on which a query was executed
+        batch_size: maximum number of rows per batch
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def redaction_template(field_names: List[str],
+                       fields: List[str]) -> Optional[str]:
+    """
+    Decides once per column whether RedactingFormatter would redact
+    its values, and compiles the result into a row template
+
+    A `name=` key also matches at the end of `username=`, so every
+    column whose name ends with one of the fields is masked. Masked
+    columns are rendered by `%.0s`, which consumes their value and
+    prints nothing, followed by the redaction.
+
+    Args:
+        field_names: the name of each column
+        fields: the fields to redact
+
+    Returns:
+        A %-format template taking every value of a row, or None if
+        the columns cannot be masked with the same result as
+        filter_datum, in which case the rows go through the regex pass
+    """
+    redaction = RedactingFormatter.REDACTION
+    if not _single_pass_safe(tuple(fields), RedactingFormatter.SEPARATOR,
+                             redaction):
+        return None
+    columns = []
+    for name in field_names:
+        if name != name.strip() or _UNSAFE_VALUE.search(name):
+            return None
+        if name.endswith(tuple(fields)):
+            value = '%.0s' + redaction.replace('%', '%%')
+        else:
+            value = '%s'
+        columns.append('{}={};'.format(name.replace('%', '%%'), value))
+    return ' '.join(columns)
+
+
+# Characters that let a value change what filter_datum matches
+_UNSAFE_VALUE = re.compile('[=;\n]')
+
+
+def format_rows(rows: List[tuple], field_names: List[str],
+                template: Optional[str] = None
+                ) -> List[Tuple[str, bool]]:
+    """
+    Formats rows as the `field=value;` messages logged by main
+
+    With a template from redaction_template, the masked values are
+    replaced by the redaction while the message is built, giving the
+    same text as RedactingFormatter would. A row holding a value with
+    a '=', the separator or a newline is left for the formatter.
+
+    Args:
+        rows: rows of the users table
+        field_names: the name of each column
+        template: the template returned by redaction_template
+
+    Returns:
+        One (message, already redacted) pair per row
+    """
+    lines = []
+    for row in rows:
+        values = tuple(map(str, row))
+        if template is None or _UNSAFE_VALUE.search(''.join(values)):
+            str_row = ''.join(f'{f}={v}; '
+                              for v, f in zip(values, field_names))
+            lines.append((str_row.strip(), False))
+        else:
+            lines.append((template % values, True))
+    return lines
+
+
+def _log_lines(logger: logging.Logger,
+               lines: List[Tuple[str, bool]]) -> None:
+    """
+    Logs the messages returned by format_rows, marking the redacted
+    ones so that RedactingFormatter skips its regex pass
+    """
+    for line, redacted in lines:
+        if redacted:
+            logger.info(line, extra=_PRE_REDACTED)
+        else:
+            logger.info(line)
+
+
+_PRE_REDACTED = {"redacted": True}
+
+
 class RedactingFormatter(logging.Formatter):
     """
     Redacting Formatter class for filtering PII fields
+
+    A record is redacted in one of three ways:
+      - a dict message, as in logger.info({"name": ...}), is redacted
+        by key;
+      - a payload, as in logger.info("...", extra={"payload": {...}}),
+        is redacted by key and its message by filter_datum;
+      - any other message is redacted by filter_datum, unless it was
+        logged with extra={"redacted": True}.
+    The record itself is left untouched for the other handlers.
     """
 
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], engine: str = "regex",
+                 output: str = "text"):
         """
         Constructor method for RedactingFormatter class
 
         Args:
             fields: list of fields to redact in log messages
+            engine: one of ENGINES, see filter_datum
+            output: one of OUTPUTS. "json" writes one JSON object per
+                record instead of the FORMAT line
         """
+        if engine not in ENGINES:
+            raise ValueError("engine must be one of {}".format(
+                ", ".join(ENGINES)))
+        if output not in OUTPUTS:
+            raise ValueError("output must be one of {}".format(
+                ", ".join(OUTPUTS)))
         super(RedactingFormatter, self).__init__(self.FORMAT)
+        self.engine = engine
+        self.output = output
         self.fields = fields
 
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        """The fields to redact in log messages"""
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields: List[str]) -> None:
+        """Sets the fields to redact and resolves their redactor once,
+        rather than on every record"""
+        self._fields = tuple(fields)
+        self._redact = _engine_redactor(self._fields, self.SEPARATOR,
+                                        self.REDACTION, self.engine)
+        # Whether each payload key seen so far is masked
+        self._masked_keys: Dict[Any, bool] = {}
+
     def format(self, record: logging.LogRecord) -> str:
         """
-        Formats the specified log record as text.
-
-        Filters values in incoming log records using filter_datum.
+        Formats the specified log record as text, or as a JSON line
         """
-        record.msg = filter_datum(self.fields, self.REDACTION,
-                                  record.getMessage(), self.SEPARATOR)
+        payload = None
+        if isinstance(record.msg, dict):
+            payload = self.redact_payload(record.msg)
+            message = None
+        else:
+            message = record.getMessage()
+            if not getattr(record, "redacted", False):
+                message = self.redact_message(message)
+            if isinstance(getattr(record, "payload", None), dict):
+                payload = self.redact_payload(record.payload)
+
+        record = copy.copy(record)
+        record.args = None
+        if self.output == "json":
+            return self._format_json(record, message, payload)
+
+        if payload is not None:
+            pairs = ' '.join('{}={}{}'.format(key, value, self.SEPARATOR)
+                             for key, value in payload.items())
+            message = pairs if message is None else message + ' ' + pairs
+        record.msg = message
         return super(RedactingFormatter, self).format(record)
 
+    def redact_message(self, message: str) -> str:
+        """
+        Redacts a `field=value;` message with filter_datum
+        """
+        if self._redact is not None:
+            return self._redact(message)
+        return filter_datum(self.fields, self.REDACTION, message,
+                            self.SEPARATOR)
+
+    def redact_payload(self, payload: Dict[Any, Any]) -> Dict[Any, Any]:
+        """
+        Returns a copy of a dict whose PII values are replaced by the
+        redaction, dicts nested in dicts, lists and tuples included
+
+        A key is masked when it ends with one of the fields, as the
+        `name=` pattern also matches `username=` in a text message.
+        Keys are looked up in a cache, so no pattern is run.
+        """
+        masked_keys = self._masked_keys
+        redacted = {}
+        for key, value in payload.items():
+            masked = masked_keys.get(key)
+            if masked is None:
+                masked = str(key).endswith(self._fields)
+                if len(masked_keys) < _MASKED_KEYS_SIZE:
+                    masked_keys[key] = masked
+            if masked:
+                redacted[key] = self.REDACTION
+            else:
+                redacted[key] = self._redact_value(value)
+        return redacted
+
+    def _redact_value(self, value: Any) -> Any:
+        """
+        Redacts the dicts held by a payload value, which may be a list
+        or a tuple of them; other values are kept as is
+        """
+        if isinstance(value, dict):
+            return self.redact_payload(value)
+        if isinstance(value, list):
+            return [self._redact_value(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(self._redact_value(item) for item in value)
+        return value
+
+    def _format_json(self, record: logging.LogRecord,
+                     message: Optional[str],
+                     payload: Optional[Dict[Any, Any]]) -> str:
+        """
+        Formats a redacted record as a JSON object on one line
+        """
+        line = {
+            "time": self.formatTime(record, self.datefmt),
+            "name": record.name,
+            "level": record.levelname,
+        }
+        if message is not None:
+            line["message"] = message
+        if payload is not None:
+            line["payload"] = payload
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line["exc_info"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+# Maximum number of payload keys remembered by a RedactingFormatter
+_MASKED_KEYS_SIZE = 4096
+
 
 if __name__ == '__main__':
     main()
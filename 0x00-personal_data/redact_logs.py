@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Redacts existing log files with the rules of RedactingFormatter
+
+Usage: ./redact_logs.py INPUT OUTPUT [--fields name,email,...]
+                        [--workers N] [--chunk-size MB] [--quiet]
+
+The input is memory-mapped and cut into chunks on line boundaries.
+Chunks are redacted by filter_datum across a process pool and written
+to the output in their original order. At most two chunks per worker
+are in flight, which bounds the memory used whatever the file size.
+The output is written to a temporary file renamed over it at the end,
+so a log can be redacted in place.
+"""
+import argparse
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, filter_datum
+
+# Default size of a chunk, in bytes
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def chunk_bounds(data: mmap.mmap,
+                 chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """
+    Cuts a mapped file into chunks ending on line boundaries
+
+    Args:
+        data: the mapped file
+        chunk_size: approximate size of a chunk, in bytes
+
+    Yields:
+        (start, end) offsets of each chunk
+    """
+    size = len(data)
+    start = 0
+    while start < size:
+        end = data.find(b'\n', min(start + chunk_size, size) - 1)
+        end = size if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+# The input file of the worker processes, see _init_worker
+_worker_data = None
+
+
+def _init_worker(path: str) -> None:
+    """
+    Maps the input file once in each worker process
+    """
+    global _worker_data
+
+    with open(path, 'rb') as f:
+        _worker_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _redact_chunk(start: int, end: int, fields: List[str],
+                  redaction: str, separator: str) -> bytes:
+    """
+    Redacts the lines between two offsets of the input file
+
+    Bytes that are not valid UTF-8 are kept as they are.
+
+    Returns:
+        The redacted chunk
+    """
+    text = _worker_data[start:end].decode('utf-8', 'surrogateescape')
+    text = filter_datum(fields, redaction, text, separator)
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def redact_file(src: str, dst: str, fields: List[str] = PII_FIELDS,
+                workers: Optional[int] = None,
+                chunk_size: int = CHUNK_SIZE,
+                progress: Optional[Callable[[int, int], None]] = None
+                ) -> int:
+    """
+    Writes a redacted copy of a log file
+
+    The copy is written next to dst, then renamed to dst once complete,
+    so dst may be src itself.
+
+    Args:
+        src: path of the log file to redact
+        dst: path of the redacted copy, which may be src
+        fields: list of fields to redact
+        workers: number of worker processes, defaults to the CPU count
+        chunk_size: approximate size of a chunk, in bytes
+        progress: called with (bytes done, total bytes) after each chunk
+
+    Returns:
+        The number of bytes read
+    """
+    workers = workers or os.cpu_count() or 1
+    fields = list(fields)
+    redaction = RedactingFormatter.REDACTION
+    separator = RedactingFormatter.SEPARATOR
+
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(dst)),
+        prefix=".{}.".format(os.path.basename(dst)), suffix=".tmp")
+    try:
+        with open(src, 'rb') as f_in, os.fdopen(fd, 'wb') as f_out:
+            size = _redact_stream(f_in, f_out, src, fields, redaction,
+                                  separator, workers, chunk_size, progress)
+        # Keeps the mode of the file replaced, or of the source
+        shutil.copymode(dst if os.path.exists(dst) else src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return size
+
+
+def _redact_stream(f_in, f_out, src: str, fields: List[str],
+                   redaction: str, separator: str, workers: int,
+                   chunk_size: int,
+                   progress: Optional[Callable[[int, int], None]]) -> int:
+    """
+    Writes the redacted content of f_in to f_out, see redact_file
+
+    Returns:
+        The number of bytes read
+    """
+    size = os.fstat(f_in.fileno()).st_size
+    if size == 0:
+        return 0
+    with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            ProcessPoolExecutor(max_workers=workers,
+                                initializer=_init_worker,
+                                initargs=(src,)) as executor:
+        pending = deque()
+        done = 0
+
+        def write_oldest():
+            nonlocal done
+            end, future = pending.popleft()
+            f_out.write(future.result())
+            done = end
+            if progress:
+                progress(done, size)
+
+        for start, end in chunk_bounds(data, chunk_size):
+            pending.append((end, executor.submit(
+                _redact_chunk, start, end, fields, redaction, separator)))
+            if len(pending) >= 2 * workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+    return size
+
+
+def _print_progress(done: int, total: int) -> None:
+    """
+    Reports the progress of redact_file on stderr
+    """
+    sys.stderr.write("\r{:6.2f}% ({} / {} bytes)".format(
+        100 * done / total, done, total))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def main():
+    """
+    Parses the command line and redacts the file
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("input", help="log file to redact")
+    parser.add_argument("output", help="path of the redacted copy")
+    parser.add_argument("--fields", default=",".join(PII_FIELDS),
+                        help="comma separated fields to redact "
+                             "(default: PII_FIELDS)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=16,
+                        help="size of a chunk in MB (default: 16)")
+    parser.add_argument("--quiet", action="store_true",
+                        help="do not report progress")
+    args = parser.parse_args()
+
+    redact_file(args.input, args.output, args.fields.split(","),
+                workers=args.workers,
+                chunk_size=args.chunk_size * 1024 * 1024,
+                progress=None if args.quiet else _print_progress)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 Route module for the API
 """
 from os import getenv
+import threading
 from api.v1.views import app_views
 from flask import Flask, jsonify, abort, request
 from flask_cors import (CORS, cross_origin)
@@ -10,6 +11,10 @@ from api.v1.auth.auth import Auth
 from api.v1.auth.basic_auth import BasicAuth
 from api.v1.auth.session_auth import SessionAuth
 from api.v1.auth.session_exp_auth import SessionExpAuth
+from api.v1.compression import COMPRESSION
+from api.v1.metrics import METRICS
+from api.v1.profiler import PROFILER
+from models.user import User
 
 
 app = Flask(__name__)
@@ -32,34 +37,74 @@ if auth_env:
     elif auth_env == 'session_exp_auth':
         auth = SessionExpAuth()
 
+# Set once the stores are loaded by load_data
+data_ready = threading.Event()
+# Paths served while the stores are loading
+ungated_paths = {'/api/v1/ready',
+                 '/api/v1/status',
+                 '/api/v1/metrics',
+                 '/api/v1/profiler'}
+
+
+def load_data() -> None:
+    """Loads the stores in memory, then marks the API as ready"""
+    try:
+        User.load_from_file()
+    except Exception:
+        app.logger.exception("Loading the stores failed")
+        return
+    data_ready.set()
+
 
 @app.before_request
 def before_request():
     """Handles request before any other"""
+    # Until the stores are loaded, only the probes are served
+    if not data_ready.is_set() and \
+            request.path.rstrip('/') not in ungated_paths:
+        abort(503)
+
     if auth is None:
+        METRICS.count_auth("disabled")
         return
 
     # Excluded paths that do not require authentication
     excluded_paths = ['/api/v1/status/',
                       '/api/v1/unauthorized/',
                       '/api/v1/forbidden/',
-                      '/api/v1/auth_session/login/']
+                      '/api/v1/auth_session/login/',
+                      '/api/v1/ready/',
+                      '/api/v1/metrics/',
+                      '/api/v1/profiler/']
 
     # Check if the path requires authentication
     if not auth.require_auth(request.path, excluded_paths):
+        METRICS.count_auth("excluded")
         return
 
     # Check for valid authorization or session
     if auth.authorization_header(request) is None \
             and auth.session_cookie(request) is None:
+        METRICS.count_auth("unauthorized")
         abort(401)
 
-    # Check for current user (which will validate the session or token)
-    if auth.current_user(request) is None:
+    # Check for current user (which will validate the session or token),
+    # timed by the metrics
+    user = METRICS.current_user(auth, request)
+    if user is None:
         abort(403)
 
     # If user is authenticated, set request current user
-    request.current_user = auth.current_user(request)
+    request.current_user = user
+
+
+# Installed once the other before_request hooks are registered
+METRICS.init_app(app)
+# Registered last, so that its after_request hook runs first and the
+# compression is timed with the view
+COMPRESSION.init_app(app)
+# Wraps app.wsgi_app only while profiling is enabled
+PROFILER.init_app(app, '/api/v1/profiler')
 
 
 @app.errorhandler(404)
@@ -81,6 +126,17 @@ def forbidden(error) -> str:
     return jsonify({"error": "Forbidden"}), 403
 
 
+@app.errorhandler(503)
+def service_unavailable(error) -> str:
+    """Request arriving before the stores are loaded"""
+    return jsonify({"error": "Service Unavailable"}), 503, \
+        {"Retry-After": "1"}
+
+
+# Loads the stores without blocking the import of the app
+threading.Thread(target=load_data, name="load-data", daemon=True).start()
+
+
 if __name__ == "__main__":
     host = getenv("API_HOST", "0.0.0.0")
     port = getenv("API_PORT", "5000")
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Negotiated gzip and brotli compression of the responses of a Flask
+app
+
+Responses of a compressible type are compressed with the best encoding
+the client accepts, brotli first when the brotli module is installed:
+  - buffered responses when their body is at least the minimum size;
+  - streamed responses chunk by chunk, unless their Content-Length is
+    known to be below the minimum size.
+
+The ETag of a compressed response gets the encoding as a suffix, so
+that the identity and the compressed bodies never share a strong tag.
+The suffix is stripped from If-None-Match before the views run, so
+that they compare the tags they set themselves.
+
+A view can also cache the compressed body of a response against its
+ETag, see cached and cache: one body is kept per name and encoding.
+
+Environment variables:
+    COMPRESSION_MIN_SIZE        smallest body compressed, in bytes,
+                                default: 1024
+    COMPRESSION_GZIP_LEVEL      1 to 9, default: 6
+    COMPRESSION_BROTLI_QUALITY  0 to 11, default: 5
+"""
+import os
+import re
+import threading
+import zlib
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from flask import Flask, Response, g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing
+COMPRESSIBLE = re.compile(
+    r"^(text/.*|application/(json|javascript|xml|.*\+json|.*\+xml))$")
+# Encoding suffix of the entity tags of compressed responses
+_SUFFIX = re.compile(r'-(gzip|br)"')
+
+
+class Compression:
+    """Compresses the responses of a Flask app"""
+
+    def __init__(self):
+        """Initialize a new Compression instance from the environment"""
+        self.min_size = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+        self.gzip_level = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+        self.brotli_quality = int(
+            os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+        self.encodings = ("br", "gzip") if brotli is not None \
+            else ("gzip",)
+        # (name, encoding): (etag, compressed body)
+        self._cache: Dict[Tuple[str, str], Tuple[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:
+        """Installs the request hooks of the compression on app
+
+        Args:
+            app (Flask): the app whose responses are compressed
+        """
+        app.before_request(self._strip_suffixes)
+        app.after_request(self._compress)
+
+    def encoding(self) -> Optional[str]:
+        """Returns the best encoding accepted by the current request,
+        or None for identity"""
+        return request.accept_encodings.best_match(self.encodings)
+
+    def cached(self, name: str, etag: str) -> Optional[Response]:
+        """Returns the cached compressed response of a view
+
+        Args:
+            name (str): the name the body was cached under
+            etag (str): the current entity tag of the resource, unquoted
+
+        Returns:
+            Response: the response, or None if no body is cached for
+            this tag and the encoding of the current request
+        """
+        encoding = self.encoding()
+        entry = self._cache.get((name, encoding))
+        if encoding is None or entry is None or entry[0] != etag:
+            return None
+        response = Response(entry[1], mimetype="application/json")
+        response.headers["Content-Encoding"] = encoding
+        g.compression_encoding = encoding
+        return response
+
+    def cache(self, name: str, etag: str) -> None:
+        """Caches the compressed body of the response of the current
+        request, if it gets compressed
+
+        Args:
+            name (str): the name to cache the body under
+            etag (str): the entity tag of the response, unquoted
+        """
+        g.compression_cache = (name, etag)
+
+    def _strip_suffixes(self) -> None:
+        """before_request hook: strips the encoding suffixes from the
+        tags of If-None-Match"""
+        header = request.environ.get("HTTP_IF_NONE_MATCH")
+        if header and _SUFFIX.search(header):
+            g.compression_if_none_match = header
+            request.environ["HTTP_IF_NONE_MATCH"] = _SUFFIX.sub('"', header)
+
+    def _compress(self, response: Response) -> Response:
+        """after_request hook: compresses the response if worth it"""
+        if not COMPRESSIBLE.match(response.mimetype or ""):
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.status_code == 304:
+            return self._not_modified(response)
+        encoding = g.get("compression_encoding")
+        if encoding is not None:
+            # Served from the cache
+            _suffix_etag(response, encoding)
+            return response
+        if response.status_code < 200 or response.status_code in (204, 206) \
+                or "Content-Encoding" in response.headers \
+                or response.direct_passthrough \
+                or "no-transform" in response.headers.get("Cache-Control",
+                                                          ""):
+            return response
+        encoding = self.encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            length = response.content_length
+            if length is not None and length < self.min_size:
+                return response
+            response.response = self._stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            data = self._compress_data(data, encoding)
+            response.set_data(data)
+            cache = g.get("compression_cache")
+            if cache is not None:
+                name, etag = cache
+                with self._lock:
+                    self._cache[(name, encoding)] = (etag, data)
+        response.headers["Content-Encoding"] = encoding
+        _suffix_etag(response, encoding)
+        return response
+
+    def _not_modified(self, response: Response) -> Response:
+        """Gives a 304 response the tag the client holds: the suffixed
+        one if it sent it"""
+        header = g.get("compression_if_none_match")
+        etag, weak = response.get_etag()
+        if header is None or etag is None:
+            return response
+        for encoding in self.encodings:
+            if '"{}-{}"'.format(etag, encoding) in header:
+                response.set_etag("{}-{}".format(etag, encoding), weak)
+                break
+        return response
+
+    def _compress_data(self, data: bytes, encoding: str) -> bytes:
+        """Returns data compressed with encoding"""
+        if encoding == "br":
+            return brotli.compress(data, quality=self.brotli_quality)
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                      zlib.MAX_WBITS | 16)
+        return compressor.compress(data) + compressor.flush()
+
+    def _stream(self, chunks: Iterable[bytes], encoding: str
+                ) -> Iterator[bytes]:
+        """Compresses a streamed body chunk by chunk
+
+        The compressor only yields once it has a block ready, so small
+        chunks are grouped; the rest is flushed at the end.
+        """
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            compress, finish = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                          zlib.MAX_WBITS | 16)
+            compress, finish = compressor.compress, compressor.flush
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                data = compress(chunk)
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+
+def _suffix_etag(response: Response, encoding: str) -> None:
+    """Appends the encoding to the ETag of a response, if it has one"""
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag("{}-{}".format(etag, encoding), weak)
+
+
+COMPRESSION = Compression()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Per-request latency histograms and auth outcome counters,
+exported in the Prometheus text format
+
+Every thread records into its own aggregator, so recording takes no
+lock. The aggregators are merged when the metrics are rendered; those
+of finished threads are folded into a single one whenever a thread
+registers its aggregator, and when the metrics are rendered, so that
+their number stays bounded by the number of live threads.
+"""
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from flask import Flask, Response, g, request
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Aggregator:
+    """Histograms and counters recorded by one thread"""
+
+    __slots__ = ("thread", "histograms", "counters")
+
+    def __init__(self, thread: threading.Thread = None):
+        """Initialize an empty aggregator
+
+        Args:
+            thread (threading.Thread, optional): the thread writing to
+            it, None for the aggregator of the finished threads.
+        """
+        self.thread = thread
+        # key: bucket counts, then the +Inf count, then the sum
+        self.histograms: Dict[tuple, List[float]] = {}
+        self.counters: Dict[tuple, int] = {}
+
+    def observe(self, key: tuple, seconds: float) -> None:
+        """Adds one value to the histogram of key"""
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+        hist[bisect_left(BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+
+    def merge(self, other: '_Aggregator') -> None:
+        """Adds the values of another aggregator to this one"""
+        for key, values in dict(other.histograms).items():
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, value in enumerate(list(values)):
+                hist[i] += value
+        for key, count in dict(other.counters).items():
+            self.counters[key] = self.counters.get(key, 0) + count
+
+
+class RequestMetrics:
+    """Records the latency of the requests of a Flask app
+
+    Three histograms are kept:
+      - the whole request, by route, method and status;
+      - the phases of a request: the before_request hooks, the
+        auth.current_user call among them, and the view with the
+        serialization of its response;
+      - the outcome of the authentication of each request.
+    """
+
+    def __init__(self):
+        """Initialize a new RequestMetrics instance"""
+        self._local = threading.local()
+        self._aggregators: List[_Aggregator] = []
+        self._finished = _Aggregator()
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:
+        """Installs the request hooks of the metrics on app
+
+        Must be called after the other before_request hooks are
+        registered, so that the first hook starts the clock and the
+        last one marks the end of the before_request phase.
+
+        Args:
+            app (Flask): the app to instrument
+        """
+        hooks = app.before_request_funcs.setdefault(None, [])
+        hooks.insert(0, self._request_started)
+        hooks.append(self._before_request_done)
+        app.after_request(self._response_ready)
+        app.teardown_request(self._request_finished)
+
+    def _aggregator(self) -> _Aggregator:
+        """Returns the aggregator of the calling thread"""
+        try:
+            return self._local.aggregator
+        except AttributeError:
+            aggregator = _Aggregator(threading.current_thread())
+            with self._lock:
+                # A server starting a thread per request registers an
+                # aggregator per request: fold the finished ones now
+                self._fold_finished()
+                self._aggregators.append(aggregator)
+            self._local.aggregator = aggregator
+            return aggregator
+
+    def _request_started(self) -> None:
+        """First before_request hook: starts the clock"""
+        g.metrics_start = perf_counter()
+
+    def _before_request_done(self) -> None:
+        """Last before_request hook: the view runs next"""
+        g.metrics_view_start = perf_counter()
+
+    def _response_ready(self, response: Response) -> Response:
+        """after_request hook: the response is built"""
+        g.metrics_view_end = perf_counter()
+        g.metrics_status = response.status_code
+        return response
+
+    def _request_finished(self, exc: BaseException = None) -> None:
+        """teardown_request hook: records the request"""
+        end = perf_counter()
+        start = g.get("metrics_start")
+        if start is None:
+            return
+        rule = request.url_rule
+        route = rule.rule if rule is not None else "<unmatched>"
+        status = g.get("metrics_status", 500)
+        aggregator = self._aggregator()
+        aggregator.observe(("request", route, request.method, status),
+                           end - start)
+
+        view_start = g.get("metrics_view_start")
+        if view_start is None:
+            # A before_request hook answered the request
+            view_start = g.get("metrics_view_end", end)
+        else:
+            aggregator.observe(("phase", "view"),
+                               g.get("metrics_view_end", end) - view_start)
+        aggregator.observe(("phase", "before_request"), view_start - start)
+
+    def current_user(self, auth, req):
+        """Calls auth.current_user(req), timing it and counting its
+        outcome
+
+        Args:
+            auth (Auth): the authentication of the app
+            req (flask.Request): the request to authenticate
+
+        Returns:
+            User: the user returned by auth.current_user
+        """
+        start = perf_counter()
+        user = auth.current_user(req)
+        aggregator = self._aggregator()
+        aggregator.observe(("phase", "auth"), perf_counter() - start)
+        outcome = "forbidden" if user is None else "authenticated"
+        counters = aggregator.counters
+        counters[(outcome,)] = counters.get((outcome,), 0) + 1
+        return user
+
+    def count_auth(self, outcome: str) -> None:
+        """Counts a request whose authentication ended without calling
+        auth.current_user
+
+        Args:
+            outcome (str): e.g. excluded, unauthorized or disabled
+        """
+        counters = self._aggregator().counters
+        counters[(outcome,)] = counters.get((outcome,), 0) + 1
+
+    def _fold_finished(self) -> None:
+        """Folds the aggregators of finished threads into one
+
+        Must be called with the lock held.
+        """
+        alive = []
+        for aggregator in self._aggregators:
+            if aggregator.thread.is_alive():
+                alive.append(aggregator)
+            else:
+                self._finished.merge(aggregator)
+        self._aggregators = alive
+
+    def collect(self) -> _Aggregator:
+        """Merges the aggregators of every thread
+
+        Returns:
+            _Aggregator: the merged values
+        """
+        merged = _Aggregator()
+        with self._lock:
+            self._fold_finished()
+            merged.merge(self._finished)
+            for aggregator in self._aggregators:
+                merged.merge(aggregator)
+        return merged
+
+    def render(self) -> str:
+        """Renders the metrics in the Prometheus text format
+
+        Returns:
+            str: the exposition text
+        """
+        merged = self.collect()
+        requests = sorted((key[1:], hist)
+                          for key, hist in merged.histograms.items()
+                          if key[0] == "request")
+        phases = sorted((key[1:], hist)
+                        for key, hist in merged.histograms.items()
+                        if key[0] == "phase")
+        lines = []
+        _render_histogram(
+            lines, "http_request_duration_seconds",
+            "Latency of the requests by route, method and status",
+            ("route", "method", "status"), requests)
+        _render_histogram(
+            lines, "http_request_phase_duration_seconds",
+            "Latency of the phases of the requests",
+            ("phase",), phases)
+        lines.append("# HELP auth_outcomes_total "
+                     "Outcome of the authentication of the requests")
+        lines.append("# TYPE auth_outcomes_total counter")
+        for (outcome,), count in sorted(merged.counters.items()):
+            lines.append('auth_outcomes_total{{outcome="{}"}} {}'.format(
+                _escape(outcome), count))
+        return "\n".join(lines) + "\n"
+
+
+def _render_histogram(lines: List[str], name: str, doc: str,
+                      label_names: Tuple[str, ...],
+                      series: List[Tuple[tuple, List[float]]]) -> None:
+    """Appends the exposition lines of a histogram to lines"""
+    lines.append("# HELP {} {}".format(name, doc))
+    lines.append("# TYPE {} histogram".format(name))
+    for labels, hist in series:
+        text = ",".join('{}="{}"'.format(label, _escape(value))
+                        for label, value in zip(label_names, labels))
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), hist):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                name, text, bound, cumulative))
+        lines.append("{}_sum{{{}}} {}".format(name, text, hist[-1]))
+        lines.append("{}_count{{{}}} {}".format(name, text, cumulative))
+
+
+def _escape(value) -> str:
+    """Escapes a label value of the Prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+METRICS = RequestMetrics()
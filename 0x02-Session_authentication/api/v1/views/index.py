@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """ Module of Index views
 """
-from flask import jsonify, abort
+from flask import Response, jsonify, abort
 from api.v1.views import app_views
+from api.v1.metrics import CONTENT_TYPE, METRICS
 
 
 @app_views.route('/status', methods=['GET'], strict_slashes=False)
@@ -14,18 +15,50 @@ def status() -> str:
     return jsonify({"status": "OK"})
 
 
+@app_views.route('/ready', methods=['GET'], strict_slashes=False)
+def ready() -> str:
+    """ GET /api/v1/ready
+    Return:
+      - whether the stores are loaded, with status 200
+      - 503 while they are loading
+    """
+    from api.v1.app import data_ready
+    if not data_ready.is_set():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True})
+
+
 @app_views.route('/stats/', strict_slashes=False)
 def stats() -> str:
     """ GET /api/v1/stats
     Return:
-      - the number of each objects
+      - the number of each objects, users by creation day and email
+        domain, the number of sessions and the size of the store,
+        from counters kept up to date, without scanning the objects
     """
+    from api.v1.app import auth
     from models.user import User
+    aggregates = User.aggregates()
     stats = {}
     stats['users'] = User.count()
+    stats['users_per_day'] = aggregates.get('created_per_day', {})
+    stats['users_per_email_domain'] = aggregates.get('email_domain', {})
+    stats['active_sessions'] = len(getattr(auth, 'user_id_by_session_id',
+                                           {}))
+    stats['storage_bytes'] = aggregates['storage_bytes']
     return jsonify(stats)
 
 
+@app_views.route('/metrics', methods=['GET'], strict_slashes=False)
+def metrics() -> str:
+    """ GET /api/v1/metrics
+    Return:
+      - the request latency histograms and auth outcome counters,
+        in the Prometheus text format
+    """
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+
 @app_views.route('/unauthorized', methods=['GET'], strict_slashes=False)
 def unauthorized() -> str:
     """GET /api/v1/unauthorized
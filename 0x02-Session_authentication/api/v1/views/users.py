@@ -1,19 +1,129 @@
 #!/usr/bin/env python3
 """ Module of Users views
 """
+from datetime import datetime, timezone
+from os import getenv
+from api.v1.compression import COMPRESSION
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import abort, jsonify, make_response, request
 from models.user import User
 
+# Largest number of users created by one POST /api/v1/users/batch
+USERS_BATCH_MAX = int(getenv("USERS_BATCH_MAX", "1000"))
+
+
+def _not_modified(etag: str, last_modified: datetime):
+    """ Answers a conditional GET before the body is built
+
+    If-None-Match takes precedence over If-Modified-Since, which is
+    only precise to the second.
+
+    Args:
+        etag (str): the entity tag of the resource, unquoted
+        last_modified (datetime): the naive UTC time of its last
+        change, or None if unknown
+
+    Returns:
+        a 304 response if the client copy is current, else None
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0,
+                                              tzinfo=timezone.utc)
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None and \
+            last_modified is not None:
+        current = last_modified <= request.if_modified_since
+    else:
+        current = False
+    if not current:
+        return None
+    return _with_validators(make_response("", 304), etag, last_modified)
+
+
+def _with_validators(response, etag: str, last_modified: datetime):
+    """ Sets the ETag and Last-Modified headers of a response
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(microsecond=0,
+                                                       tzinfo=timezone.utc)
+    return response
+
+
+def _requested_fields():
+    """ Parses the fields query parameter, a comma separated list of
+    User.JSON_FIELDS
+
+    Returns:
+        the fields in the order of User.JSON_FIELDS, or None for all
+        of them, and an error message if the parameter is invalid
+    """
+    param = request.args.get('fields')
+    if param is None:
+        return None, None
+    names = [name.strip() for name in param.split(',') if name.strip()]
+    if len(names) == 0:
+        return None, "fields empty"
+    unknown = [name for name in names if name not in User.JSON_FIELDS]
+    if len(unknown) > 0:
+        return None, "Unknown fields: {}".format(", ".join(unknown))
+    # One order for every request of the same fields, so that they
+    # share an entity tag and a cache entry
+    return tuple(f for f in User.JSON_FIELDS if f in names), None
+
+
+def _fields_etag(etag: str, fields: tuple) -> str:
+    """ Entity tag of the representation restricted to fields
+    """
+    if fields is None:
+        return etag
+    return "{}-{}".format(etag, ".".join(fields))
+
+
+def _view_user(user: User):
+    """ Answers the GET of one user, or 304 if the client copy is
+    current
+    """
+    fields, error_msg = _requested_fields()
+    if error_msg is not None:
+        return jsonify({'error': error_msg}), 400
+    etag, last_modified = _fields_etag(user.etag(), fields), user.updated_at
+    response = _not_modified(etag, last_modified)
+    if response is None:
+        response = _with_validators(jsonify(user.to_json(fields=fields)),
+                                    etag, last_modified)
+    return response
+
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameter:
+      - fields (optional): comma separated attributes to return
     Return:
       - list of all User objects JSON represented
+      - 304 if the list did not change since the client got it
+      - 400 if a field is unknown
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    fields, error_msg = _requested_fields()
+    if error_msg is not None:
+        return jsonify({'error': error_msg}), 400
+    # Read before the listing: a concurrent change makes the tag stale,
+    # never the body
+    etag = _fields_etag(User.collection_etag(), fields)
+    last_modified = User.last_modified()
+    response = _not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    name = 'users' if fields is None else \
+        'users?fields={}'.format(",".join(fields))
+    response = COMPRESSION.cached(name, etag)
+    if response is None:
+        all_users = [user.to_json(fields=fields) for user in User.all()]
+        response = jsonify(all_users)
+        COMPRESSION.cache(name, etag)
+    return _with_validators(response, etag, last_modified)
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -21,21 +131,25 @@ def view_one_user(user_id: str = None) -> str:
     """ GET /api/v1/users/:id
     Path parameter:
       - User ID
+    Query parameter:
+      - fields (optional): comma separated attributes to return
     Return:
       - User object JSON represented
+      - 304 if the User did not change since the client got it
+      - 400 if a field is unknown
       - 404 if the User ID doesn't exist
     """
     # Handle 'me' as the user_id, returning the authenticated user
     if user_id == 'me':
         if request.current_user is None:
             abort(404)
-        return jsonify(request.current_user.to_json())
+        return _view_user(request.current_user)
 
     # Standard behavior for other user_ids
     user = User.get(user_id)
     if user is None:
         abort(404)
-    return jsonify(user.to_json())
+    return _view_user(user)
 
 
 @app_views.route('/users/<user_id>', methods=['DELETE'], strict_slashes=False)
@@ -94,6 +208,65 @@ def create_user() -> str:
     return jsonify({'error': error_msg}), 400
 
 
+@app_views.route('/users/batch', methods=['POST'], strict_slashes=False)
+def create_users() -> str:
+    """ POST /api/v1/users/batch
+    JSON body:
+      - list of users, each as the body of POST /api/v1/users/
+    Return:
+      - result of each user, in order: its status, and the User
+        object JSON represented (201) or the error (400); the valid
+        users are saved with a single write of the file
+      - 400 if the body is not a list, or can't save the Users
+      - 413 if the list has more than USERS_BATCH_MAX users
+    """
+    rj = None
+    try:
+        rj = request.get_json()
+    except Exception as e:
+        rj = None
+    if type(rj) is not list:
+        return jsonify({'error': "Wrong format"}), 400
+    if len(rj) > USERS_BATCH_MAX:
+        return jsonify({'error': "Too many users, max {}".format(
+            USERS_BATCH_MAX)}), 413
+
+    users = []
+    results = []
+    for item in rj:
+        error_msg = None
+        if type(item) is not dict:
+            error_msg = "Wrong format"
+        if error_msg is None and item.get("email", "") == "":
+            error_msg = "email missing"
+        if error_msg is None and item.get("password", "") == "":
+            error_msg = "password missing"
+        if error_msg is None:
+            try:
+                user = User()
+                user.email = item.get("email")
+                user.password = item.get("password")
+                user.first_name = item.get("first_name")
+                user.last_name = item.get("last_name")
+                users.append(user)
+                results.append({'status': 201, 'user': user})
+                continue
+            except Exception as e:
+                error_msg = "Can't create User: {}".format(e)
+        results.append({'status': 400, 'error': error_msg})
+
+    if len(users) > 0:
+        try:
+            User.save_many(users)
+        except Exception as e:
+            return jsonify({'error': "Can't create Users: {}".format(e)}), \
+                400
+    for result in results:
+        if 'user' in result:
+            result['user'] = result['user'].to_json()
+    return jsonify(results), 200
+
+
 @app_views.route('/users/<user_id>', methods=['PUT'], strict_slashes=False)
 def update_user(user_id: str = None) -> str:
     """ PUT /api/v1/users/:id
@@ -132,8 +305,9 @@ def get_authenticated_user() -> str:
     """retreives the authenticated User
 
     Returns:
-        str: the authenticated user object in json str
+        str: the authenticated user object in json str, or 304 if it
+        did not change since the client got it
     """
     if request.current_user is None:
         abort(404)
-    return jsonify(request.current_user.to_json())
+    return _view_user(request.current_user)
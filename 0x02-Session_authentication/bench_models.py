@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the storage operations of models.base on User objects
+
+Usage: ./bench_models.py [--sizes 1000,10000,100000,1000000]
+                         [--budget SECONDS] [--no-memory]
+                         [--output FILE] [--baseline FILE]
+                         [--threshold RATIO]
+
+For each size N, N users are created in memory and written once, then
+each operation is timed over repeated calls, within the time budget:
+
+    to_json         User.to_json of one user
+    to_json_all     to_json of every user, as GET /api/v1/users does
+    get             User.get by id
+    search          User.search by email
+    all             User.all
+    save            User.save of a new user, which rewrites the file
+    remove          User.remove of a user saved by the save benchmark
+    save_to_file    User.save_to_file
+    load_from_file  User.load_from_file
+
+Unless --no-memory is given, each operation is run once more under
+tracemalloc to record the memory it allocates. The benchmark runs in a
+temporary directory, so the .db_User.json file of the project is never
+touched. Results are printed as JSON, or written to the output file.
+With --baseline, each mean is compared with the one of a former
+result file, and the exit status is 1 if an operation got slower than
+the threshold ratio.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from models.base import DATA
+from models.user import User
+
+OPERATIONS = ("to_json", "to_json_all", "get", "search", "all", "save",
+              "remove", "save_to_file", "load_from_file")
+PASSWORD = hashlib.sha256(b"b3nchmarkPwd").hexdigest()
+
+
+def populate(size: int) -> List[str]:
+    """
+    Replaces the users in memory by size new users, and writes them
+
+    Returns:
+        The ids of the users
+    """
+    DATA["User"] = {}
+    users = DATA["User"]
+    for i in range(size):
+        user = User(email="user{}@bench.io".format(i), _password=PASSWORD,
+                    first_name="Bench", last_name=str(i))
+        users[user.id] = user
+    User.save_to_file()
+    return list(users)
+
+
+def make_operations(ids: List[str], rng: random.Random
+                    ) -> Dict[str, Callable[[], object]]:
+    """
+    Returns a function running one call of each operation
+    """
+    size = len(ids)
+    saved = []
+
+    def save():
+        user = User(email="new{}@bench.io".format(len(saved)),
+                    _password=PASSWORD)
+        user.save()
+        saved.append(user)
+
+    def remove():
+        if saved:
+            saved.pop().remove()
+
+    return {
+        "to_json": lambda: User.get(rng.choice(ids)).to_json(),
+        "to_json_all": lambda: [user.to_json() for user in User.all()],
+        "get": lambda: User.get(rng.choice(ids)),
+        "search": lambda: User.search(
+            {"email": "user{}@bench.io".format(rng.randrange(size))}),
+        "all": User.all,
+        "save": save,
+        "remove": remove,
+        "save_to_file": User.save_to_file,
+        "load_from_file": User.load_from_file,
+    }
+
+
+def time_operation(func: Callable[[], object], budget: float,
+                   max_reps: int = 100000) -> dict:
+    """
+    Calls func until the time budget is spent, timing every call
+
+    Timings include about 50 ns of timer overhead.
+
+    Returns:
+        The number of calls, and their mean, minimum and median time
+    """
+    times = []
+    deadline = time.perf_counter() + budget
+    while len(times) < max_reps:
+        start = time.perf_counter()
+        func()
+        end = time.perf_counter()
+        times.append(end - start)
+        if end >= deadline:
+            break
+    times.sort()
+    return {
+        "reps": len(times),
+        "mean_s": sum(times) / len(times),
+        "min_s": times[0],
+        "p50_s": times[len(times) // 2],
+    }
+
+
+def trace_operation(func: Callable[[], object]) -> dict:
+    """
+    Runs func once under tracemalloc
+
+    Returns:
+        The peak of memory allocated during the call, and what was
+        still allocated after it, in KiB
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"peak_kib": round((peak - before) / 1024, 1),
+            "net_kib": round((current - before) / 1024, 1)}
+
+
+def run_size(size: int, budget: float, memory: bool) -> dict:
+    """
+    Benchmarks every operation on size users
+
+    Returns:
+        The results of each operation, see time_operation and
+        trace_operation
+    """
+    rng = random.Random(size)
+    start = time.perf_counter()
+    ids = populate(size)
+    results = {"populate_s": round(time.perf_counter() - start, 3)}
+    operations = make_operations(ids, rng)
+    for name in OPERATIONS:
+        # Removals undo the saves, and no more
+        max_reps = results["save"]["reps"] if name == "remove" else 100000
+        result = time_operation(operations[name], budget, max_reps)
+        if memory:
+            # The traced save leaves one user for the traced remove
+            result.update(trace_operation(operations[name]))
+        results[name] = result
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> dict:
+    """
+    Compares the mean times of two result files
+
+    Returns:
+        For each size and operation found in both: the baseline and
+        current means, their ratio and whether it exceeds threshold
+    """
+    comparison = {}
+    for size, operations in results["sizes"].items():
+        former = baseline.get("sizes", {}).get(size)
+        if former is None:
+            continue
+        comparison[size] = {}
+        for name in OPERATIONS:
+            if name not in operations or name not in former:
+                continue
+            ratio = operations[name]["mean_s"] / former[name]["mean_s"]
+            comparison[size][name] = {
+                "baseline_s": former[name]["mean_s"],
+                "current_s": operations[name]["mean_s"],
+                "ratio": round(ratio, 3),
+                "regression": ratio > threshold,
+            }
+    return comparison
+
+
+def main():
+    """Runs the benchmark of each size and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated numbers of users "
+                             "(default: 1000,10000,100000,1000000)")
+    parser.add_argument("--budget", type=float, default=1,
+                        help="seconds spent timing each operation "
+                             "(default: 1)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not trace the allocations")
+    parser.add_argument("--output", help="write the JSON to this file")
+    parser.add_argument("--baseline",
+                        help="former output file to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported as a regression "
+                             "(default: 1.2)")
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {
+        "config": {
+            "budget_s": args.budget,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "sizes": {},
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for size in (int(s) for s in args.sizes.split(",")):
+                results["sizes"][str(size)] = run_size(
+                    size, args.budget, not args.no_memory)
+        finally:
+            os.chdir(cwd)
+
+    regressions = False
+    if baseline is not None:
+        results["comparison"] = compare(results, baseline, args.threshold)
+        regressions = any(op["regression"]
+                          for ops in results["comparison"].values()
+                          for op in ops.values())
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
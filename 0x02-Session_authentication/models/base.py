@@ -2,19 +2,67 @@
 """ Base module
 """
 from datetime import datetime
-from typing import TypeVar, List, Iterable
+from typing import TypeVar, List, Iterable, Iterator, Tuple
 from os import path
 import json
+import re
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+# Classes whose objects in memory include every object of their file
+SYNCED = set()
+# Per class: {aggregate: {key: number of objects}}, and under
+# "storage_bytes" the size of the file as last read or written
+AGGREGATES = {}
+# Per class: {object id: keys the object is counted under}
+_COUNTED = {}
+# Identifies this process in collection ETags: generations restart
+# from 0 in every process
+EPOCH = uuid.uuid4().hex[:12]
+# Per class: number of changes to the collection, and time of the last
+GENERATIONS = {}
+MODIFIED = {}
+# Whitespace allowed between JSON tokens
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _iter_json_object(text: str) -> Iterator[Tuple[str, dict]]:
+    """ Decode the items of a JSON object one by one
+
+    json.loads decodes a whole document in one call, holding the GIL
+    until it is done; decoding each item apart lets other threads run
+    while a large store loads in the background
+    """
+    decoder = json.JSONDecoder()
+    idx = _WHITESPACE.match(text).end()
+    if text[idx:idx + 1] != '{':
+        raise ValueError("Expected a JSON object")
+    idx = _WHITESPACE.match(text, idx + 1).end()
+    if text[idx:idx + 1] == '}':
+        return
+    while True:
+        key, idx = decoder.raw_decode(text, idx)
+        idx = _WHITESPACE.match(text, idx).end()
+        if text[idx:idx + 1] != ':':
+            raise ValueError("Expected ':' at {}".format(idx))
+        idx = _WHITESPACE.match(text, idx + 1).end()
+        value, idx = decoder.raw_decode(text, idx)
+        yield key, value
+        idx = _WHITESPACE.match(text, idx).end()
+        if text[idx:idx + 1] == '}':
+            return
+        if text[idx:idx + 1] != ',':
+            raise ValueError("Expected ',' or '}}' at {}".format(idx))
+        idx = _WHITESPACE.match(text, idx + 1).end()
 
 
 class Base():
     """ Base class
     """
+    # Public attributes, which to_json can be restricted to
+    JSON_FIELDS = ('id', 'created_at', 'updated_at')
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
@@ -44,10 +92,22 @@ class Base():
             return False
         return (self.id == other.id)
 
-    def to_json(self, for_serialization: bool = False) -> dict:
+    def to_json(self, for_serialization: bool = False,
+                fields: Iterable[str] = None) -> dict:
         """ Convert the object a JSON dictionary
+
+        Only the given fields are computed if any, taken from
+        JSON_FIELDS
         """
         result = {}
+        if fields is not None:
+            for key in fields:
+                value = self.__dict__.get(key)
+                if type(value) is datetime:
+                    result[key] = value.strftime(TIMESTAMP_FORMAT)
+                else:
+                    result[key] = value
+            return result
         for key, value in self.__dict__.items():
             if not for_serialization and key[0] == '_':
                 continue
@@ -57,20 +117,117 @@ class Base():
                 result[key] = value
         return result
 
+    def _aggregate_keys(self) -> dict:
+        """ Keys the object is counted under, by aggregate; a None key
+        is not counted
+        """
+        return {'created_per_day': self.created_at.strftime("%Y-%m-%d")}
+
+    def etag(self) -> str:
+        """ Strong entity tag of the object, changed on every save
+        """
+        return "{}-{}".format(self.id,
+                              self.updated_at.strftime("%Y%m%dT%H%M%S%f"))
+
+    @classmethod
+    def _changed(cls):
+        """ Records a change to the collection of the class
+        """
+        s_class = cls.__name__
+        GENERATIONS[s_class] = GENERATIONS.get(s_class, 0) + 1
+        MODIFIED[s_class] = datetime.utcnow()
+
+    @classmethod
+    def collection_etag(cls) -> str:
+        """ Strong entity tag of the collection of the class
+        """
+        return "{}-{}".format(EPOCH, GENERATIONS.get(cls.__name__, 0))
+
+    @classmethod
+    def last_modified(cls) -> datetime:
+        """ Time of the last change to the collection of the class,
+        or None if it never changed
+        """
+        return MODIFIED.get(cls.__name__)
+
+    @classmethod
+    def _uncount(cls, obj_id: str):
+        """ Removes an object from the aggregates of its class
+        """
+        s_class = cls.__name__
+        keys = _COUNTED.setdefault(s_class, {}).pop(obj_id, None)
+        if keys is None:
+            return
+        aggregates = AGGREGATES[s_class]
+        for name, key in keys.items():
+            if key is None:
+                continue
+            counts = aggregates[name]
+            counts[key] -= 1
+            if counts[key] == 0:
+                del counts[key]
+
+    def _count(self):
+        """ Adds the object to the aggregates of its class, replacing
+        what it was counted under before
+        """
+        cls = self.__class__
+        s_class = cls.__name__
+        cls._uncount(self.id)
+        keys = self._aggregate_keys()
+        _COUNTED[s_class][self.id] = keys
+        aggregates = AGGREGATES.setdefault(s_class, {'storage_bytes': 0})
+        for name, key in keys.items():
+            if key is None:
+                continue
+            counts = aggregates.setdefault(name, {})
+            counts[key] = counts.get(key, 0) + 1
+
+    @classmethod
+    def _objects(cls) -> dict:
+        """ Return the objects of the class by id, loading them from
+        their file first if it was never read nor written
+        """
+        s_class = cls.__name__
+        if s_class not in SYNCED:
+            # Never read nor overwrite the file through a partial store
+            cls.load_from_file()
+        return DATA[s_class]
+
+    @classmethod
+    def aggregates(cls) -> dict:
+        """ Return the aggregates of the class, without scanning its
+        objects
+        """
+        s_class = cls.__name__
+        cls._objects()
+        return {name: value if type(value) is int else dict(value)
+                for name, value in AGGREGATES.get(
+                    s_class, {'storage_bytes': 0}).items()}
+
     @classmethod
     def load_from_file(cls):
         """ Load all objects from file
+
+        The objects are built apart, then swapped in at once, so that
+        readers never see a partly loaded store
         """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
-
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+        objs = {}
+        text = ""
+        if path.exists(file_path):
+            with open(file_path, 'r') as f:
+                text = f.read()
+            for obj_id, obj_json in _iter_json_object(text):
+                objs[obj_id] = cls(**obj_json)
+        DATA[s_class] = objs
+        AGGREGATES[s_class] = {'storage_bytes': len(text.encode())}
+        _COUNTED[s_class] = {}
+        for obj in objs.values():
+            obj._count()
+        cls._changed()
+        SYNCED.add(s_class)
 
     @classmethod
     def save_to_file(cls):
@@ -82,31 +239,50 @@ class Base():
         for obj_id, obj in DATA[s_class].items():
             objs_json[obj_id] = obj.to_json(True)
 
+        text = json.dumps(objs_json)
         with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+            f.write(text)
+        AGGREGATES.setdefault(s_class, {})['storage_bytes'] = len(text)
+        SYNCED.add(s_class)
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
+        objs = self.__class__._objects()
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
+        objs[self.id] = self
+        self._count()
+        self.__class__._changed()
         self.__class__.save_to_file()
 
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save several objects of the class, writing the file once
+        """
+        stored = cls._objects()
+        now = datetime.utcnow()
+        for obj in objs:
+            obj.updated_at = now
+            stored[obj.id] = obj
+            obj._count()
+        cls._changed()
+        cls.save_to_file()
+
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
+        objs = self.__class__._objects()
+        if objs.get(self.id) is not None:
+            del objs[self.id]
+            self.__class__._uncount(self.id)
+            self.__class__._changed()
             self.__class__.save_to_file()
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return len(cls._objects().keys())
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,14 +294,13 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return cls._objects().get(id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
+        objs = cls._objects()
         def _search(obj):
             if len(attributes) == 0:
                 return True
@@ -134,4 +309,4 @@ class Base():
                     return False
             return True
         
-        return list(filter(_search, DATA[s_class].values()))
+        return list(filter(_search, objs.values()))
@@ -8,6 +8,7 @@ from models.base import Base
 class User(Base):
     """ User class
     """
+    JSON_FIELDS = Base.JSON_FIELDS + ('email', 'first_name', 'last_name')
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
@@ -43,6 +44,16 @@ class User(Base):
         pwd_e = pwd.encode()
         return hashlib.sha256(pwd_e).hexdigest().lower() == self.password
 
+    def _aggregate_keys(self) -> dict:
+        """ Also count users by the domain of their email
+        """
+        keys = super()._aggregate_keys()
+        domain = None
+        if type(self.email) is str and '@' in self.email:
+            domain = self.email.rsplit('@', 1)[1].lower()
+        keys['email_domain'] = domain
+        return keys
+
     def display_name(self) -> str:
         """ Display User name based on email/first_name/last_name
         """
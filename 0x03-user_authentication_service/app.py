@@ -3,10 +3,14 @@
 from flask import (jsonify, Flask, request,
                    abort, make_response, redirect, url_for)
 from auth import Auth
+from metrics import QUERY_METRICS
+from profiler import PROFILER
 
 
 app = Flask(__name__)
 AUTH = Auth()
+# Wraps app.wsgi_app only while profiling is enabled
+PROFILER.init_app(app, "/profiler")
 
 
 @app.route("/", methods=['GET'], strict_slashes=False)
@@ -145,5 +149,13 @@ def update_password():
         return jsonify({"error": "Invalid reset token"}), 403
 
 
+@app.route("/metrics", methods=['GET'], strict_slashes=False)
+def metrics():
+    """returns the latency histograms and row counts
+    of the database statements run by this process
+    """
+    return jsonify(QUERY_METRICS.snapshot())
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port="5000")
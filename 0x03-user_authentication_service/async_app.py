@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+""" The routes of app.py served by an asyncio event loop
+
+Requires the quart package. Run it with `python3 async_app.py`,
+or under any ASGI server, e.g. `hypercorn async_app:app`.
+"""
+from quart import (jsonify, Quart, request,
+                   abort, redirect, url_for)
+from async_auth import AsyncAuth
+from metrics import QUERY_METRICS
+
+
+app = Quart(__name__)
+AUTH = AsyncAuth()
+
+
+@app.before_serving
+async def init_db():
+    """creates the tables before the first request"""
+    await AUTH._db.init_models()
+
+
+@app.after_serving
+async def close_db():
+    """releases the database connections"""
+    await AUTH._db.close()
+
+
+@app.route("/", methods=['GET'], strict_slashes=False)
+async def index():
+    """return the index page"""
+    return jsonify({"message": "Bienvenue"})
+
+
+@app.route("/users", methods=['POST'], strict_slashes=False)
+async def users():
+    """creates a user from the post request"""
+    form = await request.form
+    email = form.get('email')
+    if not email:
+        return jsonify({"error": "email is required!"}), 400
+    password = form.get('password')
+    if not password:
+        return jsonify({"error": "password is required"}), 400
+
+    try:
+        user = await AUTH.register_user(email=email, password=password)
+        return jsonify({"email": user.email, "message": "user created"})
+    except ValueError:
+        return jsonify({"message": "email already registered"}), 400
+
+
+@app.route("/sessions", methods=['POST'], strict_slashes=False)
+async def login():
+    """responds to the sessions route
+    """
+    form = await request.form
+    email = form.get('email')
+    if not email:
+        abort(401)
+    password = form.get('password')
+    if not password:
+        abort(401)
+
+    if await AUTH.valid_login(email, password):
+        user_session = await AUTH.create_session(email)
+        resp = jsonify({"email": email, "message": "logged in"})
+        resp.set_cookie("session_id", user_session)
+        return resp
+    abort(401)
+
+
+@app.route("/sessions", methods=['DELETE'], strict_slashes=False)
+async def logout():
+    """Logs out a user via session"""
+    user_session = request.cookies.get('session_id')
+
+    if user_session:
+        user = await AUTH.get_user_from_session_id(user_session)
+        if user:
+            await AUTH.destroy_session(user.id)
+            return redirect(url_for('index'))
+    abort(403)
+
+
+@app.route("/reset_password", methods=['POST'], strict_slashes=False)
+async def get_reset_password_token():
+    """Gets reset password token for user
+    expects the email field from the user
+    """
+    form = await request.form
+    req_email = form.get('email')
+    if not req_email:
+        return jsonify({"error": "email is required"}), 400
+
+    try:
+        token = await AUTH.get_reset_password_token(req_email)
+    except ValueError:
+        abort(403)
+    return jsonify({"email": req_email, "reset_token": token}), 200
+
+
+@app.route("/profile", methods=['GET'], strict_slashes=False)
+async def profile():
+    """Handles user profile"""
+    user_session = request.cookies.get('session_id')
+    if user_session:
+        user = await AUTH.get_user_from_session_id(user_session)
+        if user:
+            return jsonify({"email": user.email}), 200
+    abort(403)
+
+
+@app.route("/reset_password", methods=['PUT'], strict_slashes=False)
+async def update_password():
+    """handles the reset_password endpoint
+    """
+    form = await request.form
+    email = form.get('email')
+    if not email:
+        return jsonify({"error": "email is required"}), 400
+    reset_token = form.get('reset_token')
+    if not reset_token:
+        return jsonify({"error": "reset_token is required"}), 400
+    new_password = form.get('new_password')
+    if not new_password:
+        return jsonify({"error": "new_password is required"}), 400
+
+    if await AUTH.get_user_by(email=email) is None:
+        return jsonify({"error": "Invalid email"}), 400
+    try:
+        await AUTH.update_password(reset_token, new_password)
+    except ValueError:
+        return jsonify({"error": "Invalid reset token"}), 403
+    return jsonify({"email": email, "message": "Password updated"}), 200
+
+
+@app.route("/metrics", methods=['GET'], strict_slashes=False)
+async def metrics():
+    """returns the latency histograms and row counts
+    of the database statements run by this process
+    """
+    return jsonify(QUERY_METRICS.snapshot())
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Manages user authentication on top of AsyncDB"""
+
+import asyncio
+import bcrypt
+import os
+import uuid
+from datetime import datetime, timedelta
+from concurrent.futures import Executor
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm.exc import NoResultFound
+from typing import Union
+
+from async_db import AsyncDB
+from auth import _generate_uuid, _hash_password, _hash_token
+from user import User
+
+
+class AsyncAuth:
+    """Async counterpart of the Auth class
+
+    bcrypt runs in an executor so that hashing and checking passwords
+    never blocks the event loop.
+    """
+
+    def __init__(self, executor: Executor = None):
+        """Initialize a new AsyncAuth instance
+
+        Args:
+            executor (Executor, optional): executor running bcrypt.
+            Defaults to the default executor of the event loop.
+        """
+        self._db = AsyncDB()
+        self._executor = executor
+        # Lifetime of the reset tokens and sweeping of the expired ones
+        self.reset_token_ttl = int(os.getenv('RESET_TOKEN_TTL', '900'))
+        self.sweep_interval = float(
+            os.getenv('RESET_TOKEN_SWEEP_INTERVAL', '60'))
+        self.sweep_batch = int(os.getenv('RESET_TOKEN_SWEEP_BATCH', '100'))
+        self._sweeper = None
+
+    async def _run_blocking(self, func, *args):
+        """Runs func(*args) in the executor and awaits its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def register_user(self, email: str, password: str) -> User:
+        """Registers a user to the database
+
+        Args:
+            email (str): user email
+            password (str): user password
+
+        Raises:
+            ValueError: if a user already has this email
+
+        Returns:
+            User: return the registered user
+        """
+        if not email or not password:
+            raise ValueError("email and password is required")
+        hashed_pwd = await self._run_blocking(_hash_password, password)
+        return await self._db.add_user(email, hashed_pwd)
+
+    async def valid_login(self, email: str, password: str) -> bool:
+        """Validates user login
+
+        Args:
+            email (str): user email
+            password (str): user password
+
+        Returns:
+            bool: returns True or False based on cred validation
+        """
+        try:
+            user = await self._db.find_user_by(email=email)
+            return await self._run_blocking(bcrypt.checkpw,
+                                            str.encode(password),
+                                            user.hashed_password)
+        except Exception:
+            return False
+
+    async def create_session(self, email: str) -> str:
+        """Creates a session ID for the user with the given email
+
+        Args:
+            email (str): user email
+
+        Returns:
+            str: the session ID, or None if there is no such user
+        """
+        try:
+            user = await self._db.find_user_by(email=email)
+            session_id = _generate_uuid()
+            await self._db.update_user(user.id, session_id=session_id)
+            return session_id
+        except Exception:
+            return None
+
+    async def get_user_from_session_id(self,
+                                       session_id: str) -> Union[User, None]:
+        """Finds a user by sessionID
+
+        Args:
+            session_id (str): the session id to find
+
+        Returns:
+            User | None: returns the user or none
+        """
+        if not session_id:
+            return None
+        try:
+            return await self._db.find_user_by(session_id=session_id)
+        except Exception:
+            return None
+
+    async def destroy_session(self, user_id: int) -> None:
+        """Destroys a user session
+
+        Args:
+            user_id (int): the id of the user to destroy their session
+        """
+        await self._db.update_user(user_id, session_id=None)
+        return None
+
+    async def get_reset_password_token(self, email: str) -> str:
+        """Generates a  reset password token
+
+        Args:
+            email (str): email of user address to generate token for
+
+        Returns:
+            str: the reset token str
+        """
+        try:
+            user = await self._db.find_user_by(email=email)
+            reset_token = str(uuid.uuid4())
+            expires_at = datetime.utcnow() + timedelta(
+                seconds=self.reset_token_ttl)
+            await self._db.add_reset_token(user.id, _hash_token(reset_token),
+                                           expires_at)
+        except Exception:
+            raise ValueError({"error": "User does not exists"})
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep_forever())
+        return reset_token
+
+    async def _sweep_forever(self) -> None:
+        """Deletes the expired reset tokens in small batches,
+        every sweep_interval seconds
+        """
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                deleted = self.sweep_batch
+                while deleted == self.sweep_batch:
+                    deleted = await self._db.delete_expired_reset_tokens(
+                        datetime.utcnow(), self.sweep_batch)
+            except Exception:
+                # The next sweep will try again
+                pass
+
+    async def get_user_by(self, **kwargs) -> Union[User, None]:
+        """gets a user by given kwargs"""
+        try:
+            return await self._db.find_user_by(**kwargs)
+        except (NoResultFound, InvalidRequestError):
+            return None
+
+    async def update_password(self, reset_token: str, password: str) -> None:
+        """uses the reset_token to get a corresponding user
+
+        Args:
+            reset_token (str): token to use to get user to update password
+            password (str): user password to update
+        """
+        try:
+            # Of concurrent requests with the same token, only one
+            # gets its user
+            user_id = await self._db.consume_reset_token(
+                _hash_token(reset_token), datetime.utcnow())
+        except Exception:
+            raise ValueError()
+
+        hash_pwd = await self._run_blocking(_hash_password, password)
+        await self._db.update_user(user_id,
+                                   hashed_password=hash_pwd.decode("utf-8"))
+        return None
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Async DB module, backed by aiosqlite
+
+Requires the sqlalchemy[asyncio] and aiosqlite packages.
+"""
+from datetime import datetime
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.orm.exc import NoResultFound
+from typing import List
+
+from db import USER_COLUMNS
+from metrics import QUERY_METRICS
+from user import Base, ResetToken, User
+
+
+class AsyncDB:
+    """Async counterpart of the DB class
+
+    Every method opens its own short lived session, so a single
+    AsyncDB can be shared by many concurrent tasks.
+    """
+
+    def __init__(self) -> None:
+        """Initialize a new AsyncDB instance
+
+        The tables are created by init_models, which must be awaited
+        once before the first query.
+        """
+        self._engine = create_async_engine("sqlite+aiosqlite:///a.db",
+                                           echo=False)
+        QUERY_METRICS.attach(self._engine.sync_engine)
+        self._sessionmaker = sessionmaker(bind=self._engine,
+                                          class_=AsyncSession,
+                                          expire_on_commit=False)
+
+    async def init_models(self) -> None:
+        """Drops and creates the tables, as DB.__init__ does
+        """
+        async with self._engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+
+    async def close(self) -> None:
+        """Releases the connections of the engine
+        """
+        await self._engine.dispose()
+
+    async def add_user(self, email: str, hashed_password: str) -> User:
+        """Adds user to the database with a single INSERT,
+        relying on the unique constraint of the email column
+
+        Args:
+            email (str): the user email
+            hashed_password: the hashed user password
+
+        Raises:
+            ValueError: if email or hashed_password is missing,
+            or if a user already has this email
+            SQLAlchemyError: on any other database failure, after
+            the transaction is rolled back
+
+        Returns:
+            The created user
+        """
+        if not email or not hashed_password:
+            raise ValueError("email and password is required")
+        async with self._sessionmaker() as session:
+            try:
+                new_user = User(email=email, hashed_password=hashed_password)
+                session.add(new_user)
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                raise ValueError(f"User {email} already exists")
+            except Exception:
+                await session.rollback()
+                raise
+        return new_user
+
+    async def find_user_by(self, **kwargs) -> User:
+        """Takes arbitrary keyword arguments
+
+        Returns:
+            The first row found in the users table
+            as filtered by the method's input arguments
+        """
+        try:
+            stmt = select(User).filter_by(**kwargs)
+        except InvalidRequestError:
+            raise InvalidRequestError
+        async with self._sessionmaker() as session:
+            result = await session.execute(stmt)
+            try:
+                return result.scalars().one()
+            except NoResultFound:
+                raise NoResultFound
+
+    async def update_user(self, user_id: int, **kwargs) -> None:
+        """Updates the data of the user with the given id
+        as provided in kwargs, in a single UPDATE ... WHERE id=? statement
+
+        Args:
+            user_id (int): user_id to find
+            **Kwargs (dict): keyword arguments to update
+
+        Raises:
+            ValueError: if a key is not a column of the users table
+            NoResultFound: if no user has the given id
+        """
+        if await self._update_where(User.id == user_id, kwargs) == 0:
+            raise NoResultFound
+
+    async def update_users(self, user_ids: List[int], **kwargs) -> int:
+        """Applies the same update to every user in user_ids
+        with one UPDATE ... WHERE id IN (...) statement
+
+        Args:
+            user_ids (List[int]): ids of the users to update
+            **Kwargs (dict): keyword arguments to update
+
+        Raises:
+            ValueError: if a key is not a column of the users table
+
+        Returns:
+            int: the number of rows matched by the update
+        """
+        return await self._update_where(User.id.in_(list(user_ids)), kwargs)
+
+    async def _update_where(self, criterion, values: dict) -> int:
+        """Issues one UPDATE on the users matching criterion
+
+        Args:
+            criterion: SQL expression selecting the rows to update
+            values (dict): column names mapped to their new values
+
+        Raises:
+            ValueError: if a key is not a column of the users table
+
+        Returns:
+            int: the number of rows matched by the update
+        """
+        if not USER_COLUMNS.issuperset(values):
+            raise ValueError
+
+        async with self._sessionmaker() as session:
+            if not values:
+                # Nothing to write, only report the matching rows
+                result = await session.execute(
+                    select(User.id).where(criterion))
+                return len(result.all())
+
+            result = await session.execute(
+                update(User).where(criterion).values(**values)
+                .execution_options(synchronize_session=False))
+            await session.commit()
+            return result.rowcount
+
+    async def add_reset_token(self, user_id: int, token_hash: str,
+                              expires_at: datetime) -> None:
+        """Stores a reset token digest for a user, replacing
+        the tokens issued to that user before
+
+        Args:
+            user_id (int): the id of the user the token belongs to
+            token_hash (str): the SHA-256 digest of the token
+            expires_at (datetime): UTC time from which the token is invalid
+        """
+        async with self._sessionmaker() as session:
+            await session.execute(delete(ResetToken).where(
+                ResetToken.user_id == user_id))
+            session.add(ResetToken(token_hash=token_hash, user_id=user_id,
+                                   expires_at=expires_at))
+            await session.commit()
+
+    async def consume_reset_token(self, token_hash: str,
+                                  now: datetime) -> int:
+        """Deletes a reset token if it has not expired, in a single
+        transaction, so that only one caller can use it
+
+        Args:
+            token_hash (str): the SHA-256 digest of the token
+            now (datetime): the current UTC time
+
+        Raises:
+            NoResultFound: if no unexpired token has this digest, or
+            another caller consumed it first
+
+        Returns:
+            int: the id of the user the token belonged to
+        """
+        criterion = (ResetToken.token_hash == token_hash) & \
+            (ResetToken.expires_at > now)
+        async with self._sessionmaker() as session:
+            user_id = (await session.execute(
+                select(ResetToken.user_id).where(criterion))).scalar()
+            result = await session.execute(
+                delete(ResetToken).where(criterion)
+                .execution_options(synchronize_session=False))
+            await session.commit()
+        if user_id is None or result.rowcount != 1:
+            raise NoResultFound
+        return user_id
+
+    async def delete_expired_reset_tokens(self, now: datetime,
+                                          limit: int) -> int:
+        """Deletes at most limit reset tokens expired before now
+
+        Args:
+            now (datetime): the current UTC time
+            limit (int): maximum number of tokens to delete
+
+        Returns:
+            int: the number of deleted tokens
+        """
+        expired = select(ResetToken.token_hash).where(
+            ResetToken.expires_at < now).limit(limit)
+        async with self._engine.begin() as conn:
+            result = await conn.execute(delete(ResetToken).where(
+                ResetToken.token_hash.in_(expired.scalar_subquery())))
+            return result.rowcount
@@ -4,6 +4,10 @@
 import bcrypt
 
 
+from datetime import datetime, timedelta
+import hashlib
+import os
+import threading
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound
 import uuid
@@ -13,12 +17,66 @@ from db import DB
 from user import User
 
 
+class ResetTokenSweeper(threading.Thread):
+    """Background thread deleting expired reset tokens in small batches
+    """
+
+    def __init__(self, db: DB, interval: float, batch_size: int) -> None:
+        """Initialize the sweeper
+
+        Args:
+            db (DB): database holding the reset tokens
+            interval (float): seconds to wait between two sweeps
+            batch_size (int): maximum number of tokens deleted at once
+        """
+        super().__init__(name="reset-token-sweeper", daemon=True)
+        self._db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        """Sweeps every interval seconds until stop is called"""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                # The next sweep will try again
+                pass
+
+    def sweep(self) -> int:
+        """Deletes the expired tokens, batch by batch
+
+        Returns:
+            int: the number of deleted tokens
+        """
+        total = 0
+        while not self._stopped.is_set():
+            deleted = self._db.delete_expired_reset_tokens(
+                datetime.utcnow(), self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                break
+        return total
+
+    def stop(self) -> None:
+        """Stops the thread after its current batch"""
+        self._stopped.set()
+
+
 class Auth:
     """Auth class to interact with the authentication database.
     """
 
     def __init__(self):
         self._db = DB()
+        # Lifetime of the reset tokens and sweeping of the expired ones
+        self.reset_token_ttl = int(os.getenv('RESET_TOKEN_TTL', '900'))
+        self._sweeper = ResetTokenSweeper(
+            self._db,
+            float(os.getenv('RESET_TOKEN_SWEEP_INTERVAL', '60')),
+            int(os.getenv('RESET_TOKEN_SWEEP_BATCH', '100')))
+        self._sweeper_lock = threading.Lock()
 
     def register_user(self, email: str, password: str) -> User:
         """Registers a user to the database
@@ -27,27 +85,17 @@ class Auth:
             email (str): user email
             password (str): user password
 
+        Raises:
+            ValueError: if a user already has this email
+
         Returns:
             User: return the registered user
         """
-        # check if user with email exists
-        try:
-            user = self._db.find_user_by(email=email)
-            if user:
-                raise ValueError(f"User {email} already exists")
-        except NoResultFound:
-            # hash the passwrod
-            hashed_pwd = _hash_password(password)
-            # create the user with details
-            user = User(email=email, hashed_password=hashed_pwd)
-            # save user to the db
-            self._db.save(user)
-            # commit changes to the databases
-            self._db.commit()
-            # return user
-            return user
-        except InvalidRequestError:
+        if not email or not password:
             raise ValueError("email and password is required")
+        # One INSERT: the unique email constraint rejects a duplicate,
+        # even when two signups for the same email race
+        return self._db.add_user(email, _hash_password(password))
 
     def valid_login(self, email: str, password: str) -> bool:
         """Validates user login
@@ -124,6 +172,9 @@ class Auth:
     def get_reset_password_token(self, email: str) -> str:
         """Generates a  reset password token
 
+        Only the digest of the token is stored, and it expires
+        after reset_token_ttl seconds.
+
         Args:
             email (str): email of user address to generate token for
 
@@ -134,12 +185,22 @@ class Auth:
             user = self._db.find_user_by(email=email)
             if user:
                 reset_token = str(uuid.uuid4())
-                self._db.update_user(user.id, reset_token=reset_token)
+                expires_at = datetime.utcnow() + timedelta(
+                    seconds=self.reset_token_ttl)
+                self._db.add_reset_token(user.id, _hash_token(reset_token),
+                                         expires_at)
+                self._start_sweeper()
                 return reset_token
             raise ValueError({"error": "User does not exists"})
         except Exception:
             raise ValueError({"error": "User does not exists"})
 
+    def _start_sweeper(self) -> None:
+        """Starts the expired reset tokens sweeper once"""
+        with self._sweeper_lock:
+            if self._sweeper.ident is None:
+                self._sweeper.start()
+
     def get_user_by(self, **kwargs) -> Union[User, None]:
         """gets a user by given kwargs"""
         try:
@@ -157,23 +218,16 @@ class Auth:
             password (str): user password to update
         """
         try:
-            # Find the user by the reset token
-            user = self._db.find_user_by(reset_token=reset_token)
-            if not user:
-                raise ValueError()
-        except NoResultFound:
-            raise ValueError()
-        except InvalidRequestError:
-            raise ValueError()
-        except Exception as e:
+            # Delete the unexpired token by its digest: of concurrent
+            # requests with the same token, only one gets its user
+            user_id = self._db.consume_reset_token(
+                _hash_token(reset_token), datetime.utcnow())
+        except Exception:
             raise ValueError()
 
         hash_pwd = _hash_password(password)
         hash_pwd = hash_pwd.decode("utf-8")
-        # Update user's password and reset the reset_token to None
-        self._db.update_user(user.id,
-                             hashed_password=hash_pwd,
-                             reset_token=None)
+        self._db.update_user(user_id, hashed_password=hash_pwd)
         return None
 
 
@@ -186,6 +240,18 @@ def _generate_uuid() -> str:
     return str(uuid.uuid4())
 
 
+def _hash_token(token: str) -> str:
+    """Digests a reset token for storage
+
+    Args:
+        token (str): the token given to the user
+
+    Returns:
+        str: the hex SHA-256 digest of the token
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
 def _hash_password(password: str) -> bytes:
     """Hashes given password
 
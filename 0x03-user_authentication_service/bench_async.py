@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmarks Auth against AsyncAuth
+
+Usage: ./bench_async.py [--users N] [--lookups N] [--logins N]
+                        [--concurrency N]
+
+The benchmark runs in a temporary directory, so it never touches
+the a.db file of the project. Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_auth import AsyncAuth
+from auth import Auth
+
+PASSWORD = "b3nchmarkPwd"
+
+
+def bench_sync(n_users: int, n_lookups: int, n_logins: int) -> dict:
+    """Times session lookups and logins through Auth, one at a time
+
+    Returns:
+        dict: requests per second of each operation
+    """
+    auth = Auth()
+    emails = ["user{}@bench.io".format(i) for i in range(n_users)]
+    for email in emails:
+        auth.register_user(email, PASSWORD)
+    sessions = [auth.create_session(email) for email in emails]
+
+    start = time.perf_counter()
+    for i in range(n_lookups):
+        auth.get_user_from_session_id(sessions[i % n_users])
+    lookups = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(n_logins):
+        auth.valid_login(emails[i % n_users], PASSWORD)
+    logins = time.perf_counter() - start
+    return {"session_lookups_per_s": round(n_lookups / lookups, 1),
+            "logins_per_s": round(n_logins / logins, 1)}
+
+
+async def bench_async(n_users: int, n_lookups: int, n_logins: int,
+                      concurrency: int) -> dict:
+    """Times the same operations through AsyncAuth, with up to
+    concurrency of them in flight at once
+
+    Returns:
+        dict: requests per second of each operation
+    """
+    auth = AsyncAuth(ThreadPoolExecutor(max_workers=os.cpu_count()))
+    await auth._db.init_models()
+    emails = ["user{}@bench.io".format(i) for i in range(n_users)]
+    for email in emails:
+        await auth.register_user(email, PASSWORD)
+    sessions = [await auth.create_session(email) for email in emails]
+    limit = asyncio.Semaphore(concurrency)
+
+    async def bounded(coro):
+        async with limit:
+            return await coro
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        bounded(auth.get_user_from_session_id(sessions[i % n_users]))
+        for i in range(n_lookups)))
+    lookups = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        bounded(auth.valid_login(emails[i % n_users], PASSWORD))
+        for i in range(n_logins)))
+    logins = time.perf_counter() - start
+    await auth._db.close()
+    return {"session_lookups_per_s": round(n_lookups / lookups, 1),
+            "logins_per_s": round(n_logins / logins, 1)}
+
+
+def main():
+    """Runs both benchmarks and prints their results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_async_"))
+    results = {
+        "params": vars(args),
+        "sync": bench_sync(args.users, args.lookups, args.logins),
+        "async": asyncio.run(bench_async(args.users, args.lookups,
+                                         args.logins, args.concurrency)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 """DB module
 """
-from sqlalchemy import create_engine
+from datetime import datetime
+from sqlalchemy import create_engine, delete, select
 import sqlalchemy.exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound
+from typing import List
+import time
 
-from user import Base, User
+from metrics import QUERY_METRICS
+from user import Base, ResetToken, User
 
 
+# Mapped column names of the users table, computed once at import
+USER_COLUMNS = frozenset(User.__table__.columns.keys())
+
 
 class DB:
     """DB class
@@ -21,6 +28,7 @@ class DB:
         """Initialize a new DB instance
         """
         self._engine = create_engine("sqlite:///a.db", echo=False)
+        QUERY_METRICS.attach(self._engine)
         Base.metadata.drop_all(self._engine)
         Base.metadata.create_all(self._engine)
         self.__session = None
@@ -35,22 +43,34 @@ class DB:
         return self.__session
 
     def add_user(self, email: str, hashed_password: str) -> User:
-        """Adds user to the database
+        """Adds user to the database with a single INSERT,
+        relying on the unique constraint of the email column
 
         Args:
             email (str): the user email
             hashed_password: the hashed user password
 
+        Raises:
+            ValueError: if email or hashed_password is missing,
+            or if a user already has this email
+            SQLAlchemyError: on any other database failure, after
+            the transaction is rolled back
+
         Returns:
             The created user
         """
+        if not email or not hashed_password:
+            raise ValueError("email and password is required")
         try:
             new_user = User(email=email, hashed_password=hashed_password)
             self.save(new_user)
             self.commit()
+        except IntegrityError:
+            self._session.rollback()
+            raise ValueError(f"User {email} already exists")
         except Exception:
             self._session.rollback()
-            new_user = None
+            raise
         # return the newly created user object
         return new_user
 
@@ -66,7 +86,10 @@ class DB:
     def commit(self):
         """commit chanes to the database
         """
+        start = time.perf_counter()
         self._session.commit()
+        QUERY_METRICS.record("COMMIT",
+                             (time.perf_counter() - start) * 1000)
 
     def find_user_by(self, **kwargs) -> User:
         """Takes arbitrary keyword arguments
@@ -83,23 +106,124 @@ class DB:
             raise InvalidRequestError
 
     def update_user(self, user_id: int, **kwargs) -> None:
-        """Finds a user by id and then updates their data
-        as provided in kwargs
+        """Updates the data of the user with the given id
+        as provided in kwargs, in a single UPDATE ... WHERE id=? statement
 
         Args:
             user_id (int): user_id to find
             **Kwargs (dict): keyword arguments to update
+
+        Raises:
+            ValueError: if a key is not a column of the users table
+            NoResultFound: if no user has the given id
+        """
+        if self._update_where(User.id == user_id, kwargs) == 0:
+            raise NoResultFound
+
+    def update_users(self, user_ids: List[int], **kwargs) -> int:
+        """Applies the same update to every user in user_ids
+        with one UPDATE ... WHERE id IN (...) statement
+
+        Args:
+            user_ids (List[int]): ids of the users to update
+            **Kwargs (dict): keyword arguments to update
+
+        Raises:
+            ValueError: if a key is not a column of the users table
+
+        Returns:
+            int: the number of rows matched by the update
+        """
+        return self._update_where(User.id.in_(list(user_ids)), kwargs)
+
+    def _update_where(self, criterion, values: dict) -> int:
+        """Issues one UPDATE on the users matching criterion
+
+        Args:
+            criterion: SQL expression selecting the rows to update
+            values (dict): column names mapped to their new values
+
+        Raises:
+            ValueError: if a key is not a column of the users table
+
+        Returns:
+            int: the number of rows matched by the update
+        """
+        # Validate all the keys at once against the cached column set
+        if not USER_COLUMNS.issuperset(values):
+            raise ValueError
+
+        query = self._session.query(User).filter(criterion)
+        if not values:
+            # Nothing to write, only report the matching rows
+            return query.count()
+
+        # 'evaluate' keeps the User objects already loaded in the session
+        # in sync without selecting them again
+        matched = query.update(values, synchronize_session='evaluate')
+        self.commit()
+        return matched
+
+    def add_reset_token(self, user_id: int, token_hash: str,
+                        expires_at: datetime) -> None:
+        """Stores a reset token digest for a user, replacing
+        the tokens issued to that user before
+
+        Args:
+            user_id (int): the id of the user the token belongs to
+            token_hash (str): the SHA-256 digest of the token
+            expires_at (datetime): UTC time from which the token is invalid
         """
-        found_user = self.find_user_by(id=user_id)
+        self._session.query(ResetToken).filter(
+            ResetToken.user_id == user_id).delete(synchronize_session=False)
+        self.save(ResetToken(token_hash=token_hash, user_id=user_id,
+                             expires_at=expires_at))
+        self.commit()
 
-        # Loop over the provided kwargs to see if follow model
-        for key, value in kwargs.items():
-            # check if the attribute exists in the user model
-            if not hasattr(found_user, key):
-                raise ValueError
+    def consume_reset_token(self, token_hash: str, now: datetime) -> int:
+        """Deletes a reset token if it has not expired, in a single
+        transaction, so that only one caller can use it
 
-            # Update the attribute with teh new value
-            setattr(found_user, key, value)
+        Args:
+            token_hash (str): the SHA-256 digest of the token
+            now (datetime): the current UTC time
 
-        # Commit changes to the db
+        Raises:
+            NoResultFound: if no unexpired token has this digest, or
+            another caller consumed it first
+
+        Returns:
+            int: the id of the user the token belonged to
+        """
+        criterion = (ResetToken.token_hash == token_hash) & \
+            (ResetToken.expires_at > now)
+        user_id = self._session.execute(
+            select(ResetToken.user_id).where(criterion)).scalar()
+        deleted = self._session.execute(
+            delete(ResetToken).where(criterion)
+            .execution_options(synchronize_session=False)).rowcount
         self.commit()
+        if user_id is None or deleted != 1:
+            raise NoResultFound
+        return user_id
+
+    def delete_expired_reset_tokens(self, now: datetime,
+                                    limit: int) -> int:
+        """Deletes at most limit reset tokens expired before now
+
+        It runs on its own connection so that it can be called
+        from a background thread.
+
+        Args:
+            now (datetime): the current UTC time
+            limit (int): maximum number of tokens to delete
+
+        Returns:
+            int: the number of deleted tokens
+        """
+        expired = select(ResetToken.token_hash).where(
+            ResetToken.expires_at < now).limit(limit)
+        with self._engine.begin() as conn:
+            result = conn.execute(delete(ResetToken).where(
+                ResetToken.token_hash.in_(expired.scalar_subquery())))
+            return result.rowcount
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Query level metrics for the SQLAlchemy layer"""
+from bisect import bisect_left
+from itertools import accumulate
+import logging
+import threading
+import time
+from os import getenv
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+# Statements beyond this many distinct ones are counted together
+MAX_STATEMENTS = 200
+OTHER_STATEMENT = "<other>"
+
+slow_query_logger = logging.getLogger("db.slow_query")
+
+
+class QueryMetrics:
+    """Collects per-statement latency histograms and affected row
+    counts from SQLAlchemy engine events, and logs slow queries
+
+    rows_affected only covers INSERT, UPDATE and DELETE: the DB-API
+    rowcount is -1 for a SELECT, whose rows are fetched after the
+    statement events, so SELECTs always report 0.
+    """
+
+    def __init__(self, slow_query_ms: float = None,
+                 slow_log_interval: float = None) -> None:
+        """Initialize the metrics store
+
+        Args:
+            slow_query_ms (float): latency from which a statement is
+            logged as slow. Defaults to $SLOW_QUERY_MS or 100
+            slow_log_interval (float): minimum number of seconds between
+            two slow query log lines. Defaults to
+            $SLOW_QUERY_LOG_INTERVAL or 1
+        """
+        if slow_query_ms is None:
+            slow_query_ms = float(getenv("SLOW_QUERY_MS", "100"))
+        if slow_log_interval is None:
+            slow_log_interval = float(getenv("SLOW_QUERY_LOG_INTERVAL", "1"))
+        self.slow_query_ms = slow_query_ms
+        self.slow_log_interval = slow_log_interval
+        self._lock = threading.Lock()
+        self._statements = {}
+        self._last_slow_log = 0.0
+        self._suppressed_slow = 0
+
+    def attach(self, engine: Engine) -> None:
+        """Registers the cursor execution hooks on an engine
+
+        Args:
+            engine (Engine): the engine to instrument
+        """
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany) -> None:
+        """Stores the start time of a statement on its execution
+        context, which is dropped with the statement even if it fails
+        """
+        if context is not None:
+            context.query_start_time = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany) -> None:
+        """Records the latency and affected rows of a finished
+        statement"""
+        start = getattr(context, "query_start_time", None)
+        if start is None:
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # sqlite reports -1 for statements that are not DML
+        rows_affected = cursor.rowcount if cursor.rowcount >= 0 else 0
+        self.record(statement, elapsed_ms, rows_affected)
+        if elapsed_ms >= self.slow_query_ms:
+            self._log_slow(statement, parameters, elapsed_ms)
+
+    def _handle_error(self, exception_context) -> None:
+        """Records a statement which raised, counting it as an error"""
+        start = getattr(exception_context.execution_context,
+                        "query_start_time", None)
+        if start is None or exception_context.statement is None:
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.record(exception_context.statement, elapsed_ms, failed=True)
+
+    def record(self, statement: str, elapsed_ms: float,
+               rows_affected: int = 0, failed: bool = False) -> None:
+        """Adds one observation of a statement to its histogram
+
+        Args:
+            statement (str): the SQL text, with placeholders only
+            elapsed_ms (float): the latency of the statement
+            rows_affected (int): the number of rows it inserted,
+            updated or deleted
+            failed (bool): whether the statement raised
+        """
+        with self._lock:
+            stats = self._statements.get(statement)
+            if stats is None:
+                if len(self._statements) >= MAX_STATEMENTS:
+                    statement = OTHER_STATEMENT
+                stats = self._statements.setdefault(statement, {
+                    "count": 0,
+                    "errors": 0,
+                    "rows_affected": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                })
+            stats["count"] += 1
+            if failed:
+                stats["errors"] += 1
+            stats["rows_affected"] += rows_affected
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["buckets"][bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def _log_slow(self, statement: str, parameters,
+                  elapsed_ms: float) -> None:
+        """Logs a slow statement, at most once per slow_log_interval
+
+        Parameter values are never logged, only how many there were.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_slow_log < self.slow_log_interval:
+                self._suppressed_slow += 1
+                return
+            suppressed = self._suppressed_slow
+            self._suppressed_slow = 0
+            self._last_slow_log = now
+        n_params = len(parameters) if parameters else 0
+        slow_query_logger.warning(
+            "slow query (%.1f ms): %s [%d parameters redacted]"
+            " (%d slow queries suppressed)",
+            elapsed_ms, statement, n_params, suppressed)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Returns a copy of the collected metrics
+
+        Returns:
+            dict: the statistics of each statement, with cumulative
+            histogram buckets keyed by their upper bound
+        """
+        labels = ["le_{}".format(b) for b in LATENCY_BUCKETS_MS]
+        labels.append("le_inf")
+        with self._lock:
+            statements = {}
+            for statement, stats in self._statements.items():
+                statements[statement] = {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "rows_affected": stats["rows_affected"],
+                    "total_ms": round(stats["total_ms"], 3),
+                    "max_ms": round(stats["max_ms"], 3),
+                    "histogram_ms": dict(zip(labels,
+                                             accumulate(stats["buckets"]))),
+                }
+            return {"statements": statements,
+                    "slow_query_ms": self.slow_query_ms,
+                    "slow_queries_suppressed": self._suppressed_slow}
+
+    def reset(self) -> None:
+        """Drops every collected metric"""
+        with self._lock:
+            self._statements = {}
+            self._suppressed_slow = 0
+
+
+# Metrics shared by every DB instance of the process
+QUERY_METRICS = QueryMetrics()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""On-demand profiler of a Flask app
+
+Disabled, the profiler leaves app.wsgi_app untouched and costs nothing.
+Enabled, by environment variable or through its admin route, it wraps
+app.wsgi_app and:
+  - runs every Nth request under cProfile, adding the result to the
+    profile of its route, written as <route>.pstats;
+  - samples the stacks of requests running longer than a threshold,
+    adding them to the collapsed stacks of their route, written as
+    <route>.collapsed, ready for flamegraph.pl or speedscope.
+
+Environment variables:
+    PROFILER_ENABLED       1 to profile from startup, default: 0
+    PROFILER_DIR           where the profiles are written,
+                           default: profiles
+    PROFILER_EVERY         profile one request out of N, 0 for none,
+                           default: 100
+    PROFILER_SLOW_MS       sample requests running longer than this,
+                           0 for none, default: 0
+    PROFILER_INTERVAL_MS   interval between two stack samples,
+                           default: 5
+    PROFILER_ADMIN_TOKEN   token of the admin route, which answers
+                           404 when it is not set
+"""
+import cProfile
+import hmac
+import itertools
+import os
+import pstats
+import re
+import sys
+import threading
+from time import perf_counter
+from typing import Dict, Optional
+
+from flask import Flask, abort, jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+
+class Profiler:
+    """Profiles the requests of a Flask app on demand"""
+
+    def __init__(self):
+        """Initialize a new Profiler instance from the environment"""
+        self.directory = os.getenv("PROFILER_DIR", "profiles")
+        self.every = int(os.getenv("PROFILER_EVERY", "100"))
+        self.slow_ms = float(os.getenv("PROFILER_SLOW_MS", "0"))
+        self.interval_ms = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+        self.admin_token = os.getenv("PROFILER_ADMIN_TOKEN")
+        self.profiled = 0
+        self.sampled = 0
+        self._app = None
+        self._wsgi_app = None
+        self._lock = threading.Lock()
+        # Only one cProfile profile can run at a time
+        self._profile_lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._stats: Dict[str, pstats.Stats] = {}
+        # route: {collapsed stack: samples}
+        self._stacks: Dict[str, Dict[str, int]] = {}
+        self._dirty = set()
+        # thread id: (route, start) of the requests in flight
+        self._running: Dict[int, tuple] = {}
+        self._sampler = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether app.wsgi_app is wrapped by the profiler"""
+        return self._app is not None and \
+            self._app.wsgi_app == self._profiled_wsgi_app
+
+    def init_app(self, app: Flask, admin_url: str) -> None:
+        """Registers the admin route on app, and enables the profiler
+        if PROFILER_ENABLED is set
+
+        Args:
+            app (Flask): the app to profile
+            admin_url (str): the URL of the admin route
+        """
+        self._app = app
+        app.add_url_rule(admin_url, "profiler_admin", self._admin,
+                         methods=["GET", "POST"], strict_slashes=False)
+        if os.getenv("PROFILER_ENABLED", "0").lower() in ("1", "true"):
+            self.enable()
+
+    def enable(self, every: int = None, slow_ms: float = None) -> None:
+        """Starts profiling the requests
+
+        Args:
+            every (int, optional): profile one request out of every.
+            slow_ms (float, optional): sample the requests running
+            longer than slow_ms.
+        """
+        with self._lock:
+            if every is not None:
+                self.every = every
+            if slow_ms is not None:
+                self.slow_ms = slow_ms
+            os.makedirs(self.directory, exist_ok=True)
+            if not self.enabled:
+                self._wsgi_app = self._app.wsgi_app
+                self._app.wsgi_app = self._profiled_wsgi_app
+            if self.slow_ms > 0 and self._sampler is None:
+                self._stop.clear()
+                self._sampler = threading.Thread(
+                    target=self._sample_forever, name="profiler-sampler",
+                    daemon=True)
+                self._sampler.start()
+
+    def disable(self) -> None:
+        """Stops profiling, and writes the profiles collected so far"""
+        with self._lock:
+            if self.enabled:
+                self._app.wsgi_app = self._wsgi_app
+            sampler, self._sampler = self._sampler, None
+        if sampler is not None:
+            self._stop.set()
+            sampler.join()
+        self._flush_stacks()
+
+    def _profiled_wsgi_app(self, environ, start_response):
+        """Runs the wrapped WSGI app, profiling the request if it is
+        the Nth one, and exposing it to the sampler"""
+        route = self._route(environ)
+        ident = threading.get_ident()
+        self._running[ident] = (route, perf_counter())
+        try:
+            every = self.every
+            if every > 0 and next(self._counter) % every == 0 and \
+                    self._profile_lock.acquire(blocking=False):
+                try:
+                    profile = cProfile.Profile()
+                    result = profile.runcall(self._wsgi_app, environ,
+                                             start_response)
+                finally:
+                    self._profile_lock.release()
+                self._add_profile(route, profile)
+                return result
+            return self._wsgi_app(environ, start_response)
+        finally:
+            self._running.pop(ident, None)
+
+    def _route(self, environ) -> str:
+        """Returns the method and URL rule of a request"""
+        try:
+            rule, _ = self._app.url_map.bind_to_environ(environ).match(
+                return_rule=True)
+            path = rule.rule
+        except (HTTPException, RequestRedirect):
+            path = "<unmatched>"
+        return "{} {}".format(environ.get("REQUEST_METHOD"), path)
+
+    def _add_profile(self, route: str, profile: cProfile.Profile) -> None:
+        """Adds a request profile to its route, and writes it"""
+        with self._lock:
+            stats = self._stats.get(route)
+            if stats is None:
+                stats = self._stats[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            stats.dump_stats(self._path(route, "pstats"))
+            self.profiled += 1
+
+    def _sample_forever(self) -> None:
+        """Samples the stacks of the slow requests until disabled"""
+        interval = self.interval_ms / 1000
+        last_flush = perf_counter()
+        while not self._stop.wait(interval):
+            if self.slow_ms > 0:
+                self._sample(perf_counter() - self.slow_ms / 1000)
+            if perf_counter() - last_flush >= 1:
+                self._flush_stacks()
+                last_flush = perf_counter()
+
+    def _sample(self, started_before: float) -> None:
+        """Records the stack of every request started before
+        started_before"""
+        slow = {ident: route
+                for ident, (route, start) in list(self._running.items())
+                if start < started_before}
+        if not slow:
+            return
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, route in slow.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stacks = self._stacks.setdefault(route, {})
+                stack = _collapse(frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+                self._dirty.add(route)
+                self.sampled += 1
+
+    def _flush_stacks(self) -> None:
+        """Writes the collapsed stacks of the routes sampled since the
+        last flush"""
+        with self._lock:
+            for route in self._dirty:
+                with open(self._path(route, "collapsed"), "w") as f:
+                    for stack, count in sorted(self._stacks[route].items()):
+                        f.write("{} {}\n".format(stack, count))
+            self._dirty.clear()
+
+    def _path(self, route: str, extension: str) -> str:
+        """Returns the file holding a profile of a route"""
+        name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_")
+        return os.path.join(self.directory,
+                            "{}.{}".format(name, extension))
+
+    def _admin(self):
+        """GET, POST <admin_url>
+        Requires the X-Profiler-Token header. POST takes a JSON body:
+          - enabled (bool)
+          - every (int, optional)
+          - slow_ms (float, optional)
+        Return:
+          - the state of the profiler
+          - 404 if PROFILER_ADMIN_TOKEN is not set
+          - 403 if the token is wrong
+        """
+        if not self.admin_token:
+            abort(404)
+        token = request.headers.get("X-Profiler-Token", "")
+        if not hmac.compare_digest(token.encode(),
+                                   self.admin_token.encode()):
+            abort(403)
+        if request.method == "POST":
+            body = request.get_json(silent=True) or {}
+            if body.get("enabled", True):
+                self.enable(_optional(body, "every", int),
+                            _optional(body, "slow_ms", float))
+            else:
+                self.disable()
+        return jsonify({"enabled": self.enabled, "every": self.every,
+                        "slow_ms": self.slow_ms,
+                        "directory": os.path.abspath(self.directory),
+                        "profiled": self.profiled,
+                        "sampled": self.sampled})
+
+
+def _collapse(frame) -> str:
+    """Returns a stack in the collapsed format, root frame first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _optional(body: dict, key: str, kind: type) -> Optional[float]:
+    """Returns body[key] converted to kind, or None if missing
+
+    Raises a 400 error on a value of the wrong type.
+    """
+    if body.get(key) is None:
+        return None
+    try:
+        return kind(body[key])
+    except (TypeError, ValueError):
+        abort(400)
+
+
+PROFILER = Profiler()
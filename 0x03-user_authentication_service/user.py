@@ -2,7 +2,7 @@
 """SQLA Alchemy User Model"""
 # import declaravive_base
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 
 # create a base class
 Base = declarative_base()
@@ -13,7 +13,7 @@ class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, unique=True)
     hashed_password = Column(String(250), nullable=False)
     session_id = Column(String(250), nullable=True)
     reset_token = Column(String(250), nullable=True)
@@ -22,3 +22,17 @@ class User(Base):
         """Standard string represnetation for the user object"""
         return "<User(email='%s', session_id='%s')>" % (
             self.email, self.session_id)
+
+
+class ResetToken(Base):
+    """Reset password token model for the reset_tokens table
+
+    Only the SHA-256 digest of a token is stored. It is the primary key,
+    so looking a token up walks the table's B-tree index.
+    """
+    __tablename__ = 'reset_tokens'
+
+    token_hash = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
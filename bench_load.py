@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+"""
+End-to-end load benchmark of the three authentication services
+
+Usage: ./bench_load.py [--apps basic,session,service] [--users N]
+                       [--threads N] [--duration S] [--warmup S]
+                       [--boot-timeout S] [--output FILE]
+
+Each app is copied to a temporary directory, seeded with N synthetic
+users and booted on a free local port, so the files of the projects
+are never touched. Threads then drive a mix of logins, authenticated
+GETs, user CRUD and password resets against it over keep-alive HTTP
+connections:
+
+    basic    0x01-Basic_authentication, AUTH_TYPE=basic_auth
+    session  0x02-Session_authentication, AUTH_TYPE=session_auth
+    service  0x03-user_authentication_service
+
+Throughput and p50/p95/p99 latencies are reported per endpoint as
+JSON, on stdout or in the output file, to compare releases.
+"""
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.cookies import SimpleCookie
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import bcrypt
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = "b3nchmarkPwd"
+SESSION_NAME = "_my_session_id"
+# Same layout as models.base.TIMESTAMP_FORMAT
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Share of the seeded users of the service app kept for password resets
+RESET_SHARE = 0.1
+
+
+class Client:
+    """
+    Keep-alive HTTP client of one load thread, with a cookie jar,
+    timing every request under an endpoint label
+    """
+
+    def __init__(self, port: int, window: Tuple[float, float]):
+        """
+        Constructor method for Client class
+
+        Args:
+            port: local port of the app
+            window: (start, end) perf_counter times between which
+                requests are recorded when they start, warmup requests
+                being dropped
+        """
+        self.conn = http.client.HTTPConnection("127.0.0.1", port,
+                                               timeout=60)
+        self.window = window
+        self.cookies: Dict[str, str] = {}
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def request(self, label: str, method: str, path: str,
+                form: Optional[dict] = None, json_body: Optional[dict] = None,
+                headers: Optional[dict] = None) -> Tuple[int, bytes]:
+        """
+        Sends a request and records its latency under label
+
+        A status of 400 or more, or a failed connection, counts as an
+        error of the endpoint.
+
+        Returns:
+            The status and body of the response, status 0 on failure
+        """
+        headers = dict(headers or {})
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif json_body is not None:
+            body = json.dumps(json_body)
+            headers["Content-Type"] = "application/json"
+        if self.cookies:
+            headers["Cookie"] = "; ".join(
+                "{}={}".format(k, v) for k, v in self.cookies.items())
+
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body, headers)
+            resp = self.conn.getresponse()
+            data = resp.read()
+            status = resp.status
+            for cookie in resp.headers.get_all("Set-Cookie") or []:
+                for name, morsel in SimpleCookie(cookie).items():
+                    self.cookies[name] = morsel.value
+            if resp.will_close:
+                self.conn.close()
+        except (OSError, http.client.HTTPException):
+            # The next request opens a new connection
+            self.conn.close()
+            status, data = 0, b""
+        end = time.perf_counter()
+
+        if self.window[0] <= start < self.window[1]:
+            self.latencies.setdefault(label, []).append(end - start)
+            if status == 0 or status >= 400:
+                self.errors[label] = self.errors.get(label, 0) + 1
+        return status, data
+
+
+class Scenario:
+    """
+    Requests driven against an app by one load thread
+
+    Subclasses list their operations in ops, as (weight, method name)
+    pairs. An operation may send several requests, each one timed
+    under its own endpoint label.
+    """
+
+    ops: List[Tuple[int, str]] = []
+
+    def __init__(self, client: Client, seed: dict, thread: int,
+                 threads: int):
+        """
+        Constructor method for Scenario class
+
+        Args:
+            client: the client of the thread
+            seed: what seed() returned for the app
+            thread: index of the thread
+            threads: number of threads
+        """
+        self.client = client
+        self.seed = seed
+        self.rng = random.Random(thread)
+        # Each thread logs in as its own seeded users
+        self.own = list(range(thread, len(seed["emails"]), threads))
+        self.created: List[str] = []
+        self.counter = 0
+        self.thread = thread
+
+    def setup(self) -> None:
+        """Prepares the thread, e.g. opens a session"""
+
+    def step(self) -> None:
+        """Runs one operation picked at random by weight"""
+        weights = [weight for weight, _ in self.ops]
+        name = self.rng.choices(self.ops, weights)[0][1]
+        getattr(self, name)()
+
+    def own_user(self) -> int:
+        """Returns the index of one of the users of the thread"""
+        return self.rng.choice(self.own)
+
+    def new_email(self) -> str:
+        """Returns an email no user has yet"""
+        self.counter += 1
+        return "new{}-{}-{}@bench.io".format(self.thread, self.counter,
+                                             uuid.uuid4().hex[:8])
+
+
+class BasicScenario(Scenario):
+    """Basic authentication: every request carries the credentials"""
+
+    ops = [(1, "status"), (4, "get_user"), (1, "list_users"),
+           (1, "create_user"), (1, "update_user"), (1, "delete_user")]
+
+    def setup(self) -> None:
+        """Picks the credentials of the thread"""
+        email = self.seed["emails"][self.own_user()]
+        token = base64.b64encode("{}:{}".format(email, PASSWORD).encode())
+        self.auth = {"Authorization": "Basic " + token.decode()}
+
+    def status(self) -> None:
+        """GET /api/v1/status"""
+        self.client.request("GET /api/v1/status", "GET", "/api/v1/status")
+
+    def get_user(self) -> None:
+        """GET /api/v1/users/:id of a seeded user"""
+        user_id = self.rng.choice(self.seed["ids"])
+        self.client.request("GET /api/v1/users/:id", "GET",
+                            "/api/v1/users/" + user_id, headers=self.auth)
+
+    def list_users(self) -> None:
+        """GET /api/v1/users"""
+        self.client.request("GET /api/v1/users", "GET", "/api/v1/users",
+                            headers=self.auth)
+
+    def create_user(self) -> None:
+        """POST /api/v1/users"""
+        status, data = self.client.request(
+            "POST /api/v1/users", "POST", "/api/v1/users",
+            json_body={"email": self.new_email(), "password": PASSWORD,
+                       "first_name": "Bench"},
+            headers=self.auth)
+        if status == 201:
+            self.created.append(json.loads(data)["id"])
+
+    def update_user(self) -> None:
+        """PUT /api/v1/users/:id of a user created by the thread"""
+        if not self.created:
+            return self.create_user()
+        self.client.request("PUT /api/v1/users/:id", "PUT",
+                            "/api/v1/users/" + self.rng.choice(self.created),
+                            json_body={"last_name": "Load"},
+                            headers=self.auth)
+
+    def delete_user(self) -> None:
+        """DELETE /api/v1/users/:id of a user created by the thread"""
+        if not self.created:
+            return self.create_user()
+        self.client.request("DELETE /api/v1/users/:id", "DELETE",
+                            "/api/v1/users/" + self.created.pop(),
+                            headers=self.auth)
+
+
+class SessionScenario(BasicScenario):
+    """Session authentication: requests carry a session cookie"""
+
+    ops = [(2, "login"), (5, "me"), (3, "get_user"), (1, "list_users"),
+           (1, "create_user"), (1, "update_user"), (1, "delete_user"),
+           (1, "logout")]
+
+    def setup(self) -> None:
+        """Opens the session of the thread"""
+        self.auth = {}
+        self.login()
+
+    def login(self) -> None:
+        """POST /api/v1/auth_session/login"""
+        email = self.seed["emails"][self.own_user()]
+        self.client.request("POST /api/v1/auth_session/login", "POST",
+                            "/api/v1/auth_session/login",
+                            form={"email": email, "password": PASSWORD})
+
+    def me(self) -> None:
+        """GET /api/v1/users/me"""
+        self.client.request("GET /api/v1/users/me", "GET",
+                            "/api/v1/users/me")
+
+    def logout(self) -> None:
+        """DELETE /api/v1/auth_session/logout, then logs in again"""
+        self.client.request("DELETE /api/v1/auth_session/logout", "DELETE",
+                            "/api/v1/auth_session/logout")
+        self.login()
+
+
+class ServiceScenario(Scenario):
+    """User authentication service: bcrypt logins and session cookies"""
+
+    ops = [(2, "login"), (6, "profile"), (1, "register"),
+           (1, "reset_password"), (1, "logout")]
+
+    def __init__(self, *args, **kwargs):
+        """Splits the users of the thread between logins and resets"""
+        super(ServiceScenario, self).__init__(*args, **kwargs)
+        n_reset = int(len(self.seed["emails"]) * RESET_SHARE)
+        first_reset = len(self.seed["emails"]) - n_reset
+        self.resets = [i for i in self.own if i >= first_reset]
+        self.own = [i for i in self.own if i < first_reset] or self.own
+
+    def setup(self) -> None:
+        """Opens the session of the thread"""
+        self.login()
+
+    def login(self) -> None:
+        """POST /sessions"""
+        email = self.seed["emails"][self.own_user()]
+        self.client.request("POST /sessions", "POST", "/sessions",
+                            form={"email": email, "password": PASSWORD})
+
+    def profile(self) -> None:
+        """GET /profile"""
+        self.client.request("GET /profile", "GET", "/profile")
+
+    def register(self) -> None:
+        """POST /users"""
+        self.client.request("POST /users", "POST", "/users",
+                            form={"email": self.new_email(),
+                                  "password": PASSWORD})
+
+    def reset_password(self) -> None:
+        """POST /reset_password, then PUT /reset_password with the
+        token, on a user kept for resets"""
+        if not self.resets:
+            return self.profile()
+        email = self.seed["emails"][self.rng.choice(self.resets)]
+        status, data = self.client.request(
+            "POST /reset_password", "POST", "/reset_password",
+            form={"email": email})
+        if status != 200:
+            return
+        self.client.request(
+            "PUT /reset_password", "PUT", "/reset_password",
+            form={"email": email, "new_password": PASSWORD,
+                  "reset_token": json.loads(data)["reset_token"]})
+
+    def logout(self) -> None:
+        """DELETE /sessions, then logs in again"""
+        self.client.request("DELETE /sessions", "DELETE", "/sessions")
+        self.login()
+
+
+def seed_models(directory: str, n_users: int) -> dict:
+    """
+    Writes the .db_User.json file loaded by the models of the
+    basic and session apps
+
+    Returns:
+        The ids and emails of the users
+    """
+    now = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    password = hashlib.sha256(PASSWORD.encode()).hexdigest().lower()
+    ids = [str(uuid.uuid4()) for _ in range(n_users)]
+    emails = ["user{}@bench.io".format(i) for i in range(n_users)]
+    users = {}
+    for user_id, email in zip(ids, emails):
+        users[user_id] = {"id": user_id, "created_at": now,
+                          "updated_at": now, "email": email,
+                          "_password": password, "first_name": "Bench",
+                          "last_name": "User"}
+    with open(os.path.join(directory, ".db_User.json"), "w") as f:
+        json.dump(users, f)
+    return {"ids": ids, "emails": emails}
+
+
+def seed_service(directory: str, n_users: int) -> dict:
+    """
+    Inserts the users in the a.db file of the service app, which
+    creates its tables when it boots
+
+    Every user shares one bcrypt hash, made with the cost of the app,
+    as hashing each password would take hours for a million users.
+
+    Returns:
+        The emails of the users
+    """
+    hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt())
+    emails = ["user{}@bench.io".format(i) for i in range(n_users)]
+    db = sqlite3.connect(os.path.join(directory, "a.db"), timeout=60)
+    with db:
+        db.executemany(
+            "INSERT INTO users (email, hashed_password) VALUES (?, ?)",
+            ((email, hashed) for email in emails))
+    db.close()
+    return {"ids": [], "emails": emails}
+
+
+# name: (project, app module, readiness path, environment, scenario,
+#        seeding function, seeded before boot)
+APPS = {
+    "basic": ("0x01-Basic_authentication", "api.v1.app", "/api/v1/status",
+              {"AUTH_TYPE": "basic_auth"}, BasicScenario, seed_models,
+              True),
+    "session": ("0x02-Session_authentication", "api.v1.app",
+                "/api/v1/ready",
+                {"AUTH_TYPE": "session_auth", "SESSION_NAME": SESSION_NAME},
+                SessionScenario, seed_models, True),
+    "service": ("0x03-user_authentication_service", "app", "/", {},
+                ServiceScenario, seed_service, False),
+}
+
+
+def free_port() -> int:
+    """Returns a local TCP port no one listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def boot(directory: str, module: str, ready_path: str, env: dict,
+         timeout: float) -> Tuple[subprocess.Popen, int]:
+    """
+    Starts an app with the Flask server and waits until its readiness
+    path answers below 500: the session app answers 503 on
+    /api/v1/ready until its store is loaded
+
+    Returns:
+        The server process and its port
+    """
+    port = free_port()
+    code = ("from {} import app; "
+            "app.run(host='127.0.0.1', port={}, threaded=True)"
+            ).format(module, port)
+    log = open(os.path.join(directory, "server.log"), "wb")
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=directory,
+                            env=dict(os.environ, **env),
+                            stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", ready_path)
+            status = conn.getresponse().status
+            conn.close()
+            if status < 500:
+                return proc, port
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    proc.wait()
+    with open(os.path.join(directory, "server.log"), "rb") as f:
+        tail = f.read()[-2000:].decode(errors="replace")
+    raise RuntimeError("{} did not start:\n{}".format(module, tail))
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Returns the p-th percentile of sorted values, in ms"""
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return round(values[rank - 1] * 1000, 3)
+
+
+def summarize(clients: List[Client], duration: float) -> dict:
+    """
+    Merges the latencies recorded by the clients into per endpoint
+    throughput and percentiles
+    """
+    merged: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    for client in clients:
+        for label, values in client.latencies.items():
+            merged.setdefault(label, []).extend(values)
+        for label, count in client.errors.items():
+            errors[label] = errors.get(label, 0) + count
+
+    endpoints = {}
+    for label in sorted(merged):
+        values = sorted(merged[label])
+        endpoints[label] = {
+            "requests": len(values),
+            "errors": errors.get(label, 0),
+            "throughput_rps": round(len(values) / duration, 2),
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "p99_ms": percentile(values, 99),
+        }
+    total = sum(e["requests"] for e in endpoints.values())
+    return {
+        "requests": total,
+        "errors": sum(e["errors"] for e in endpoints.values()),
+        "throughput_rps": round(total / duration, 2),
+        "endpoints": endpoints,
+    }
+
+
+def run_app(name: str, n_users: int, threads: int, warmup: float,
+            duration: float, boot_timeout: float) -> dict:
+    """
+    Seeds, boots and loads one app, then stops it
+
+    Returns:
+        The summary of the run, see summarize
+    """
+    project, module, ready_path, env, scenario, seed, before = APPS[name]
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, project)
+        shutil.copytree(os.path.join(ROOT, project), directory,
+                        ignore=shutil.ignore_patterns(
+                            "__pycache__", ".db_*.json", "a.db"))
+        start = time.perf_counter()
+        if before:
+            seeded = seed(directory, n_users)
+        proc, port = boot(directory, module, ready_path, env,
+                          boot_timeout)
+        try:
+            if not before:
+                seeded = seed(directory, n_users)
+            setup_s = time.perf_counter() - start
+
+            begin = time.perf_counter() + warmup
+            window = (begin, begin + duration)
+            clients = [Client(port, window) for _ in range(threads)]
+            scenarios = [scenario(client, seeded, i, threads)
+                         for i, client in enumerate(clients)]
+
+            def load(s: Scenario) -> None:
+                s.setup()
+                while time.perf_counter() < window[1]:
+                    s.step()
+
+            workers = [threading.Thread(target=load, args=(s,))
+                       for s in scenarios]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    result = summarize(clients, duration)
+    result["setup_s"] = round(setup_s, 2)
+    return result
+
+
+def main():
+    """Runs the benchmark of each app and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--apps", default="basic,session,service",
+                        help="comma separated apps to load "
+                             "(default: basic,session,service)")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="users seeded in each app (default: 1000)")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="concurrent load threads (default: 8)")
+    parser.add_argument("--warmup", type=float, default=2,
+                        help="seconds of load not recorded (default: 2)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds of recorded load (default: 10)")
+    parser.add_argument("--boot-timeout", type=float, default=300,
+                        help="seconds allowed to boot an app "
+                             "(default: 300)")
+    parser.add_argument("--output", help="write the JSON to this file")
+    args = parser.parse_args()
+
+    results = {
+        "config": {
+            "users": args.users,
+            "threads": args.threads,
+            "warmup_s": args.warmup,
+            "duration_s": args.duration,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "apps": {},
+    }
+    for name in args.apps.split(","):
+        results["apps"][name] = run_app(name, args.users, args.threads,
+                                        args.warmup, args.duration,
+                                        args.boot_timeout)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()